@@ -12,8 +12,15 @@ Code for parsing Sage code blocks sensibly.
 #                  http://www.gnu.org/licenses/                                         #
 #########################################################################################
 
+import __builtin__
+import ast
+import bisect
+import collections
+import inspect
+import re
 import string
 import traceback
+import types
 
 def get_input(prompt):
     try:
@@ -53,7 +60,33 @@ def preparse_code(code):
     import sage.all_cmdline
     return sage.all_cmdline.preparse(code, ignore_prompts=True)
 
+def preparser_state():
+    """
+    Return what the result of preparse_code depends on besides the code,
+    i.e., the implicit multiplication level of Sage's preparser.
+    """
+    try:
+        import sage.misc.preparser
+        return sage.misc.preparser.implicit_multiplication()
+    except (ImportError, AttributeError):
+        return None
+
+_QUOTE = re.compile(r"""['"]""")
+_QUOTE_OR_COMMENT = re.compile(r"""['"#]""")
+
 def strip_string_literals(code, state=None):
+    """
+    Replace the string literals and comments in code by %(L1)s, %(L2)s,
+    etc. (and % by %%), so code can be analyzed without being confused
+    by them.  Returns the new code, the dict mapping labels to the
+    literals, so that new_code%literals == code, and the state (the
+    quote still open at the end of code, and whether it is a raw
+    string), which may be passed in to continue with more code.
+
+    Each step searches for the next character that matters -- a quote,
+    or # outside of a string -- so code is scanned once, however many
+    literals it has.
+    """
     new_code = []
     literals = {}
     counter = 0
@@ -64,19 +97,16 @@ def strip_string_literals(code, state=None):
     else:
         in_quote, raw = state
     while True:
-        sig_q = code.find("'", q)
-        dbl_q = code.find('"', q)
-        hash_q = code.find('#', q)
-        q = min(sig_q, dbl_q)
-        if q == -1: q = max(sig_q, dbl_q)
-        if not in_quote and hash_q != -1 and (q == -1 or hash_q < q):
+        m = (_QUOTE if in_quote else _QUOTE_OR_COMMENT).search(code, q)
+        q = -1 if m is None else m.start()
+        if q != -1 and code[q] == '#':
             # it's a comment
-            newline = code.find('\n', hash_q)
+            newline = code.find('\n', q)
             if newline == -1: newline = len(code)
             counter += 1
             label = "L%s" % counter
-            literals[label] = code[hash_q:newline]   # changed from sage
-            new_code.append(code[start:hash_q].replace('%','%%'))
+            literals[label] = code[q:newline]   # changed from sage
+            new_code.append(code[start:q].replace('%','%%'))
             new_code.append("%%(%s)s" % label)
             start = q = newline
         elif q == -1:
@@ -143,24 +173,85 @@ def end_of_expr(s):
         i += 1
     return i
 
-# NOTE: The dec_args dict will leak memory over time.  However, it only
-# contains code that was entered, so it should never get big.  It
-# seems impossible to know for sure whether a bit of code will be
-# eventually needed later, so this leakiness seems necessary.
-dec_counter = 0
-dec_args = {}
+# Maximum number of cells whose division into blocks is remembered.
+BLOCKS_CACHE_SIZE = 128
+_blocks_cache = collections.OrderedDict()   # code --> blocks
 
-# Divide the input code (a string) into blocks of code.
 def divide_into_blocks(code):
-    global dec_counter
+    """
+    Divide the input code (a string) into blocks of code, each a list
+    [first line, last line, code] (line numbers count non-empty lines).
+
+    The blocks of a cell are remembered (up to BLOCKS_CACHE_SIZE cells),
+    so executing it again, e.g., when an interact is updated, doesn't
+    parse it again.
+    """
+    blocks = _blocks_cache.get(code)
+    if blocks is not None:
+        del _blocks_cache[code]
+    else:
+        blocks = _divide_into_blocks(code)
+    _blocks_cache[code] = blocks
+    while len(_blocks_cache) > BLOCKS_CACHE_SIZE:
+        _blocks_cache.popitem(last=False)
+    return [list(b) for b in blocks]
+
+def _start_tree(depth, prev_start):
+    """
+    Return a segment tree over the lines of a cell for _last_start: a
+    list whose leaves (from len(tree)//2 on) are the bracket depths
+    before the lines that can start a block, and None for the others,
+    and whose other nodes are the smallest depths of their two children.
+    """
+    size = 1
+    while size < len(depth) - 1:
+        size *= 2
+    tree = [None]*(2*size)
+    for k in range(len(depth) - 1):
+        if prev_start[k+1] == k:
+            tree[size + k] = depth[k]
+    for j in range(size - 1, 0, -1):
+        a, b = tree[2*j], tree[2*j+1]
+        if a is None or b is None:
+            tree[j] = a if b is None else b
+        else:
+            tree[j] = (min(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]))
+    return tree
+
+def _last_start(tree, end, d):
+    """
+    Return the last line before end that can start a block and whose
+    bracket depths are all at most those in d, or -1 if there is none.
 
+    Subtrees in which the smallest depth of some bracket exceeds d are
+    skipped, so this visits few nodes, unless lines above end that are
+    deeper in one bracket and shallower in another are interleaved.
+    """
+    size = len(tree)//2
+    stack = [(1, 0, size)]
+    while stack:
+        j, lo, hi = stack.pop()
+        m = tree[j]
+        if lo >= end or m is None or m[0] > d[0] or m[1] > d[1] or m[2] > d[2]:
+            continue
+        if j >= size:
+            return lo
+        mid = (lo + hi)//2
+        stack.append((2*j, lo, mid))
+        stack.append((2*j+1, mid, hi))  # searched first
+    return -1
+
+def _divide_into_blocks(code):
     # strip string literals from the input, so that we can parse it without having to worry about strings
     code, literals, state = strip_string_literals(code)
 
     # divide the code up into line lines.
     code = code.splitlines()
 
-    # Compute the line-level code decorators.
+    # Compute the line-level code decorators.  A line with code decorators
+    # becomes a call to salvus.execute_with_code_decorators, whose arguments
+    # are a literal in the code itself, so they last exactly as long as it
+    # does (e.g., in the body of a function defined by the cell).
     c = list(code)
     try:
         v = []
@@ -181,15 +272,12 @@ def divide_into_blocks(code):
                 # then code decorators impacts the rest of the code.
                 sexpr = expr.strip()
                 if i == 0 and (len(sexpr) == 0 or sexpr.startswith('#')):
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])'%(line[:i], dec_counter)
                     expr = ('\n'.join(code[len(v)+1:]))%literals
                     done = True
-                else:
-                    # Expr is nonempty -- code decorator only impacts this line
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])'%(line[:i], dec_counter)
-
-                dec_args[dec_counter] = ([line[i+2:j]%literals], expr)
-                dec_counter += 1
+                # otherwise expr is nonempty -- code decorator only impacts this line
+                label = "D%s" % len(literals)
+                literals[label] = repr(([line[i+2:j]%literals], expr))
+                new_line = '%ssalvus.execute_with_code_decorators(*%%(%s)s)'%(line[:i], label)
             else:
                 new_line = line
             v.append(new_line)
@@ -208,30 +296,64 @@ def divide_into_blocks(code):
     # take only non-empty lines now for Python code.
     code = [x for x in code if x.strip()]
 
-    # Compute the blocks
-    i = len(code)-1
+    # remove comments
+    for k, v in literals.iteritems():
+        if v.startswith('#'):
+            literals[k] = ''
+
+    # Compute the blocks, from the last line up: a block ends where the
+    # one after it starts, and starts at the nearest line above its end
+    # that is not a continuation (indented, or starting with a string)
+    # and after which no bracket is closed that wasn't opened.  If there
+    # is no such line, the last line is a block by itself.
+    #
+    # One forward pass computes, for each line k, the bracket depths
+    # before it (depth[k]) and the nearest line above it that is not a
+    # continuation (prev_start[k]).  The scan for the start of a block
+    # then only visits lines that could start one, and if it doesn't
+    # find one within a few of them, the rest is searched in a tree of
+    # the smallest depths of such lines (see _last_start); so pasting
+    # indented code, or code that closes brackets it never opened,
+    # doesn't rescan the whole cell per line.
+    n = len(code)
+    depth = [(0, 0, 0)]*(n + 1)
+    prev_start = [-1]*(n + 1)
+    paren_depth = brack_depth = curly_depth = 0
+    start = -1
+    for k, x in enumerate(code):
+        if not (x[0] in string.whitespace or x[:2] == '%('):
+            start = k
+        paren_depth += x.count('(') - x.count(')')
+        brack_depth += x.count('[') - x.count(']')
+        curly_depth += x.count('{') - x.count('}')
+        depth[k+1] = (paren_depth, brack_depth, curly_depth)
+        prev_start[k+1] = start
+
+    end = n   # code[:end] is still to be divided
     blocks = []
-    while i >= 0:
-        stop = i
-        paren_depth = code[i].count('(') - code[i].count(')')
-        brack_depth = code[i].count('[') - code[i].count(']')
-        curly_depth = code[i].count('{') - code[i].count('}')
-        while i>=0 and ((len(code[i]) > 0 and (code[i][0] in string.whitespace or code[i][:2] == '%(')) or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
-            i -= 1
-            if i >= 0:
-                paren_depth += code[i].count('(') - code[i].count(')')
-                brack_depth += code[i].count('[') - code[i].count(']')
-                curly_depth += code[i].count('{') - code[i].count('}')
-        # remove comments
-        for k, v in literals.iteritems():
-            if v.startswith('#'):
-                literals[k] = ''
-        block = ('\n'.join(code[i:]))%literals
-        bs = block.strip()
+    tree = None
+    while end > 0:
+        stop = end - 1
+        d = depth[end]
+        i = prev_start[end]
+        scanned = 0
+        while i >= 0 and not (depth[i][0] <= d[0] and depth[i][1] <= d[1] and depth[i][2] <= d[2]):
+            scanned += 1
+            if scanned == 8:
+                if tree is None:
+                    tree = _start_tree(depth, prev_start)
+                i = _last_start(tree, i, d)
+                break
+            i = prev_start[i]
+        if i >= 0:
+            block, end = code[i:end], i
+        else:
+            # no line starts the block; the last line is one by itself
+            block, end = code[end-1:end], end - 1
+        bs = ('\n'.join(block)%literals).strip()
         if bs: # has to not be only whitespace
-            blocks.insert(0, [i, stop, bs])
-        code = code[:i]
-        i = len(code)-1
+            blocks.append([i, stop, bs])
+    blocks.reverse()
 
     # merge try/except/finally/decorator/else/elif blocks
     i = 1
@@ -293,8 +415,348 @@ def is_valid_identifier(target):
 # Keywords from http://docs.python.org/release/2.7.2/reference/lexical_analysis.html
 _builtin_completions = __builtins__.keys() + ['and', 'del', 'from', 'not', 'while', 'as', 'elif', 'global', 'or', 'with', 'assert', 'else', 'if', 'pass', 'yield', 'break', 'except', 'import', 'print', 'class', 'exec', 'in', 'raise', 'continue', 'finally', 'is', 'return', 'def', 'for', 'lambda', 'try']
 
-def introspect(code, namespace, preparse=True):
+def _completion_key(x):
+    # completions are listed case insensitively
+    return (x.lower(), x)
+
+class PrefixIndex(object):
+    """
+    A sorted index of names, for listing those that start with a prefix
+    (in the order completions are listed) in time proportional to their
+    number, rather than to the number of names.
+
+    The names always include fixed; the others are brought up to date
+    with a namespace by sync, which only inserts and removes the names
+    that were added to or deleted from it since the last sync.  See
+    also namespace_changed.
+    """
+    def __init__(self, names=(), fixed=()):
+        self._fixed = frozenset(x for x in fixed if isinstance(x, basestring))
+        self._names = set(x for x in names if isinstance(x, basestring))
+        self._rebuild()
+
+    def _rebuild(self):
+        self._sorted = sorted(_completion_key(x) for x in self._fixed.union(self._names))
+
+    def sync(self, namespace):
+        """
+        Make the names (besides the fixed ones) those in namespace, a
+        dict (its keys) or a list.
+        """
+        changed = self._names.symmetric_difference(namespace)
+        if not changed:
+            return
+        removed = [x for x in changed if x in self._names]
+        added = [x for x in changed if x not in self._names and isinstance(x, basestring)]
+        self._names.difference_update(removed)
+        self._names.update(added)
+        if len(removed) + len(added) > max(64, len(self._sorted)//16):
+            self._rebuild()
+            return
+        v = self._sorted
+        for x in removed:
+            if x not in self._fixed:
+                del v[bisect.bisect_left(v, _completion_key(x))]
+        for x in added:
+            if x not in self._fixed:
+                bisect.insort(v, _completion_key(x))
+
+    def completions(self, prefix):
+        """
+        Return the sorted list of names that start with prefix.
+        """
+        v = self._sorted
+        if not prefix:
+            return [x for _, x in v]
+        p = prefix.lower()
+        i = bisect.bisect_left(v, (p,))
+        n = len(v)
+        result = []
+        while i < n and v[i][0].startswith(p):
+            x = v[i][1]
+            if x.startswith(prefix):
+                result.append(x)
+            i += 1
+        return result
+
+_namespace_index  = PrefixIndex(fixed=_builtin_completions)
+_namespace_synced = None   # the namespace whose names _namespace_index has, unless it changed since
+
+# Maximum number of classes whose attributes are remembered (see attribute_completions).
+ATTRIBUTE_CACHE_SIZE = 256
+_attribute_cache = collections.OrderedDict()   # class --> (_code_runs, _class_version(class), PrefixIndex of dir(class))
+_code_runs = 0   # number of calls to namespace_changed
+
+def namespace_changed():
+    """
+    Note that code ran, so it may have changed the names in the
+    namespace and the attributes of classes: the next completions sync
+    the index of names with the namespace and check that classes are
+    the same.  Between runs of code, e.g., while the user presses tab on
+    each keystroke, completions only look up the indexes.
+    """
+    global _namespace_synced, _code_runs
+    _namespace_synced = None
+    _code_runs += 1
+
+def _class_version(cls):
+    # what dir(cls) depends on: the classes it is made of and their attribute names
+    return tuple([(c, frozenset(c.__dict__)) for c in inspect.getmro(cls)])
+
+def namespace_completions(namespace, target):
     """
+    Return the sorted list of the names in namespace and the builtins
+    that start with target.  The names include those that the namespace
+    binds on first use, if it has a lazy_names method (see
+    sage_server.Namespace.lazy).
+    """
+    global _namespace_synced
+    if namespace is not _namespace_synced:
+        names = namespace
+        lazy = getattr(namespace, 'lazy_names', None)
+        lazy = lazy() if lazy is not None else None
+        if lazy:
+            names = namespace.keys() + lazy
+        _namespace_index.sync(names)
+        _namespace_synced = namespace
+    return _namespace_index.completions(target)
+
+def attribute_completions(O, target):
+    """
+    Return the sorted list of the attributes of O (what dir(O) and
+    O.trait_names() list) that start with target, leaving out private
+    ones unless target starts with '_'.
+
+    The attributes an object gets from its class are listed once per
+    class (up to ATTRIBUTE_CACHE_SIZE classes), and again only when the
+    class or one of its bases gained or lost attributes when code ran.
+    """
+    t = type(O)
+    if hasattr(t, '__dir__') or t in (types.InstanceType, types.ModuleType):
+        cls = None   # dir(O) isn't determined by a class
+    elif isinstance(O, (type, types.ClassType)):
+        cls, v = O, []
+    elif getattr(O, '__class__', None) is t:
+        d = getattr(O, '__dict__', None)
+        cls, v = t, (d.keys() if isinstance(d, dict) else [])
+    else:
+        cls = None
+
+    if cls is None:
+        index, v = None, dir(O)
+    else:
+        cached = _attribute_cache.pop(cls, None)
+        if cached is not None and cached[0] == _code_runs:
+            version, index = cached[1:]
+        else:
+            version = _class_version(cls)
+            if cached is not None and cached[1] == version:
+                index = cached[2]
+            else:
+                index = PrefixIndex(dir(cls))
+        _attribute_cache[cls] = (_code_runs, version, index)
+        while len(_attribute_cache) > ATTRIBUTE_CACHE_SIZE:
+            _attribute_cache.popitem(last=False)
+
+    try:
+        trait_names = _getattr(O, 'trait_names', False)   # not by __getattr__
+    except ValueError:
+        pass
+    else:
+        v = v + list(trait_names())
+    v = [x for x in v if isinstance(x, basestring) and x.startswith(target)]
+    if index is not None:
+        w = index.completions(target)
+        v = sorted(set(v).union(w), key=_completion_key) if v else w
+    else:
+        v = sorted(set(v), key=_completion_key)
+    if not target.startswith('_'):
+        v = [x for x in v if x and not x.startswith('_')]
+    return v
+
+# Descriptors whose __get__ runs no other code: functions, methods and slots
+# of classes, and methods of builtin types (also their getsets; see _bind).
+_SAFE_DESCRIPTORS = (types.FunctionType, types.MethodType, staticmethod, classmethod,
+                     types.MemberDescriptorType, type(str.join), type(object.__init__),
+                     type(dict.__dict__['fromkeys']))
+# Descriptors that are returned as they are when looked up on a class.
+_CLASS_DESCRIPTORS = (property, types.GetSetDescriptorType)
+_SAFE_GETITEM = (list.__getitem__, tuple.__getitem__, str.__getitem__, unicode.__getitem__)
+_missing = object()
+
+def _lookup(mro, name):
+    for c in mro:
+        d = c.__dict__
+        if name in d:
+            return d[name]
+    return _missing
+
+def _module(O):
+    # The module a lazily imported module (sage_server.LazyModule, whose
+    # attributes all come from __getattr__) stands for, imported now if
+    # it wasn't yet, since looking into it is what the user asked for.
+    t = type(O)
+    if t is not types.ModuleType and isinstance(O, types.ModuleType):
+        resolve = _lookup(inspect.getmro(t), '_lazy_resolve')
+        if resolve is not _missing:
+            return resolve(O)
+    return O
+
+def _bind(x, O, cls, name, descriptors):
+    # O.name (O is _missing: cls.name), where x was found as name in the dict
+    # of a class and is what getattr would use
+    if (isinstance(x, _SAFE_DESCRIPTORS) or (O is _missing and isinstance(x, _CLASS_DESCRIPTORS)) or
+           (isinstance(x, types.GetSetDescriptorType) and x.__objclass__.__module__ == '__builtin__')):
+        return getattr(cls if O is _missing else O, name)
+    if hasattr(type(x), '__get__'):
+        if descriptors:
+            return x
+        raise ValueError("%s is computed by a %s"%(name, type(x).__name__))
+    return x
+
+def _getattr(O, name, descriptors):
+    # O.name, found in the dicts of O and its classes, as getattr would.
+    O = _module(O)
+    t = type(O)
+    if t is types.ModuleType:
+        if name in O.__dict__:
+            return O.__dict__[name]
+        raise ValueError("module has no attribute '%s'"%name)
+    if not isinstance(t.__getattribute__, type(object.__init__)):
+        raise ValueError("%s defines __getattribute__"%t.__name__)
+    if isinstance(O, (type, types.ClassType)):
+        mro = inspect.getmro(t)
+        x = _lookup(mro, name)
+        if x is _missing or not hasattr(type(x), '__set__'):  # a data descriptor of the metaclass comes first
+            y = _lookup(inspect.getmro(O), name)
+            if y is not _missing:
+                return _bind(y, _missing, O, name, descriptors)
+        if x is not _missing:
+            return _bind(x, O, t, name, descriptors)
+    else:
+        cls = O.__class__ if t is types.InstanceType else t
+        mro = inspect.getmro(cls)
+        x = _lookup(mro, name)
+        if x is not _missing and hasattr(type(x), '__set__'):  # a data descriptor comes first
+            return _bind(x, O, cls, name, descriptors)
+        if t is types.InstanceType:
+            d = O.__dict__
+        else:
+            d = _lookup(mro, '__dict__')
+            d = d.__get__(O, cls) if isinstance(d, types.GetSetDescriptorType) else None
+        if isinstance(d, dict) and name in d:
+            return d[name]
+        if x is not _missing:
+            return _bind(x, O, cls, name, descriptors)
+    if _lookup(mro, '__getattr__') is not _missing:
+        raise ValueError("%s defines __getattr__"%mro[0].__name__)
+    raise ValueError("no attribute '%s'"%name)
+
+def _getitem(O, key):
+    getitem = getattr(type(O), '__getitem__', None)
+    if getitem is dict.__getitem__:
+        if dict.__contains__(O, key):   # not __missing__
+            return dict.__getitem__(O, key)
+        raise ValueError("no key %r"%(key,))
+    if getitem in _SAFE_GETITEM:
+        return getitem(O, key)
+    raise ValueError("%s defines __getitem__"%type(O).__name__)
+
+def _resolve(node, namespace, descriptors, numbers):
+    if isinstance(node, ast.Name):
+        if node.id in namespace:
+            return _module(namespace[node.id])
+        if node.id in __builtin__.__dict__:
+            return __builtin__.__dict__[node.id]
+        raise ValueError("name '%s' is not defined"%node.id)
+    if isinstance(node, ast.Attribute):
+        return _getattr(_resolve(node.value, namespace, False, numbers), node.attr, descriptors)
+    if isinstance(node, ast.Subscript):
+        if not isinstance(node.slice, ast.Index):
+            raise ValueError("only subscripts by a constant are looked up")
+        return _getitem(_resolve(node.value, namespace, False, numbers), _constant(node.slice.value))
+    if not numbers and not isinstance(node, (ast.Str, ast.List, ast.Tuple, ast.Dict)):
+        raise ValueError("numbers are preparsed")
+    return _constant(node)
+
+def _constant(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise ValueError("only names, attributes and subscripts by constants are looked up")
+
+def resolve(expr, namespace, descriptors=False, numbers=True):
+    """
+    Return the object that the expression expr (a string) refers to in
+    namespace, without evaluating code, so without side effects.  expr
+    may only consist of names, attributes and subscripts of lists,
+    tuples, strings and dicts by constants, starting with a name or a
+    constant (a number only if numbers is true, since the preparser
+    changes those).
+
+    Attributes are looked up in the dicts of objects and their classes;
+    methods are bound, but an attribute computed by other code (e.g., a
+    property or __getattr__) is not looked up, unless descriptors is
+    true and it is the last one, in which case its descriptor (e.g.,
+    the property) is returned.  A module that is imported lazily (see
+    sage_server.lazy_import) is imported, and looked up in instead.
+
+    Raise SyntaxError if expr isn't an expression, and ValueError if it
+    can't be resolved this way.
+    """
+    node = ast.parse(expr.strip(), mode='eval').body
+    try:
+        return _resolve(node, namespace, descriptors, numbers)
+    except ValueError:
+        raise
+    except Exception, err:   # e.g., IndexError
+        raise ValueError(repr(err))
+
+def _evaluate(obj, before_expr, namespace, preparse):
+    # Evaluate the code before_expr and then obj in namespace, and return
+    # the value of obj (and obj, which may be replaced by a subexpression).
+    #
+    # This is dangerous and a priori could take
+    # forever, so we spend at most 1 second doing this --
+    # if it takes longer a signal kills the evaluation.
+    # Obviously, this could in fact lock if
+    # non-interruptable code is called, which should be rare.
+    try:
+        import signal
+        def mysig(*args): raise KeyboardInterrupt
+        signal.signal(signal.SIGALRM, mysig)
+        signal.alarm(1)
+        import sage.all_cmdline
+        if before_expr.strip():
+            try:
+                exec (before_expr if not preparse else preparse_code(before_expr)) in namespace
+            except Exception, msg:
+                pass
+                # uncomment for debugging only
+                # traceback.print_exc()
+            namespace_changed()
+        # We first try to evaluate the part of the expression before the name
+        try:
+            O = eval(obj if not preparse else preparse_code(obj), namespace)
+        except SyntaxError:
+            # If that fails, we try on a subexpression.
+            obj = guess_last_expression(obj)
+            O = eval(obj if not preparse else preparse_code(obj), namespace)
+    finally:
+        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+    return O, obj
+
+def introspect(code, namespace, preparse=True, evaluate=False):
+    """
+    Completions, docstring or source code for the end of the code; see
+    namespace_changed for when completions of names are recomputed.
+
+    The object whose attributes, docstring or source code are wanted is
+    looked up without running any code (see resolve).  If that fails, or
+    there is code before the expression on the line, the code is
+    evaluated instead (for at most one second), but only if evaluate is
+    true.
+
     INPUT:
 
     - code -- a string containing Sage (if preparse=True) or Python code.
@@ -304,6 +766,8 @@ def introspect(code, namespace, preparse=True):
 
     - preparse -- a boolean
 
+    - evaluate -- a boolean
+
     OUTPUT:
 
     An object: {'result':, 'target':, 'expr':, 'status':, 'get_help':, 'get_completions':, 'get_source':}
@@ -377,43 +841,28 @@ def introspect(code, namespace, preparse=True):
                         target = expr
 
         if get_completions and target == expr:
-            j      = len(expr)
-            v      = [x[j:] for x in (namespace.keys() + _builtin_completions) if x.startswith(expr)]
+            v      = namespace_completions(namespace, expr)
         else:
 
-            # We will try to evaluate
-            # obj.  This is danerous and a priori could take
-            # forever, so we spend at most 1 second doing this --
-            # if it takes longer a signal kills the evaluation.
-            # Obviously, this could in fact lock if
-            # non-interruptable code is called, which should be rare.
-
+            # Find the object obj refers to: look it up, or if that fails
+            # (or the line has code to run first) and it is allowed, evaluate it.
             O = None
-            try:
-                import signal
-                def mysig(*args): raise KeyboardInterrupt
-                signal.signal(signal.SIGALRM, mysig)
-                signal.alarm(1)
-                import sage.all_cmdline
-                if before_expr.strip():
-                    try:
-                        exec (before_expr if not preparse else preparse_code(before_expr)) in namespace
-                    except Exception, msg:
-                        pass
-                        # uncomment for debugging only
-                        # traceback.print_exc()
-                # We first try to evaluate the part of the expression before the name
+            error = None
+            if evaluate and before_expr.strip():
+                O, obj = _evaluate(obj, before_expr, namespace, preparse)
+            else:
                 try:
-                    O = eval(obj if not preparse else preparse_code(obj), namespace)
-                except SyntaxError:
-                    # If that fails, we try on a subexpression.
-                    # TODO: This will not be needed when
-                    # this code is re-written to parse using an
-                    # AST, instead of using this lame hack.
-                    obj = guess_last_expression(obj)
-                    O = eval(obj if not preparse else preparse_code(obj), namespace)
-            finally:
-                signal.signal(signal.SIGALRM, signal.SIG_IGN)
+                    try:
+                        O = resolve(obj, namespace, descriptors=not get_completions, numbers=not preparse)
+                    except SyntaxError:
+                        # If obj isn't an expression, we try a subexpression.
+                        obj = guess_last_expression(obj)
+                        O = resolve(obj, namespace, descriptors=not get_completions, numbers=not preparse)
+                except (SyntaxError, ValueError), err:
+                    if evaluate:
+                        O, obj = _evaluate(obj, '', namespace, preparse)
+                    else:
+                        error = err
 
             def get_file():
                 try:
@@ -422,7 +871,13 @@ def introspect(code, namespace, preparse=True):
                 except Exception, err:
                     return "Unable to read source filename (%s)"%err
 
-            if get_help:
+            if error is not None:
+                if get_completions:
+                    v = []
+                else:
+                    result = "Unable to look up %s without evaluating code (%s)"%(obj, error)
+
+            elif get_help:
                 import sage.misc.sageinspect
                 result = get_file()
                 try:
@@ -458,18 +913,14 @@ def introspect(code, namespace, preparse=True):
 
             elif get_completions:
                 if O is not None:
-                    v = dir(O)
-                    if hasattr(O, 'trait_names'):
-                        v += O.trait_names()
-                    if not target.startswith('_'):
-                        v = [x for x in v if x and not x.startswith('_')]
-                    j = len(target)
-                    v = [x[j:] for x in v if x.startswith(target)]
+                    v = attribute_completions(O, target)
                 else:
                     v = []
 
         if get_completions:
-            result = list(sorted(set(v), lambda x,y:cmp(x.lower(),y.lower())))
+            # v is the sorted list of names that start with target
+            j      = len(target)
+            result = [x[j:] for x in v]
 
     except Exception, msg:
         traceback.print_exc()
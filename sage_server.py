@@ -35,22 +35,39 @@ sys.path.insert(0, PWD)
 # used for clearing pylab figure
 pylab = None
 
-# Maximum number of distinct (non-once) output messages per cell; when this number is
-# exceeded, an exception is raised; this reduces the chances of the user creating
-# a huge unusable worksheet.
+# Output of a session is rate limited by two token buckets, which keeps a runaway
+# print loop from flooding the hub and creating a huge unusable worksheet.
+# Up to MAX_OUTPUT_MESSAGES distinct (non-once) output messages, with a total of
+# MAX_OUTPUT_BURST_SIZE characters, can be sent at once; the buckets refill at
+# OUTPUT_MESSAGES_PER_SECOND messages and OUTPUT_CHARS_PER_SECOND characters per second.
+# While throttled, stdout and stderr are coalesced (up to MAX_PENDING_OUTPUT_SIZE
+# characters) and other output messages are dropped; each cell ends with a summary
+# of what was dropped.
 MAX_OUTPUT_MESSAGES = 256
+MAX_OUTPUT_BURST_SIZE = 1000000
+OUTPUT_MESSAGES_PER_SECOND = 20
+OUTPUT_CHARS_PER_SECOND = 200000
+MAX_PENDING_OUTPUT_SIZE = 200000
 # stdout, stderr, html, etc. that exceeds this many characters will be truncated to avoid
 # killing the client.
 MAX_STDOUT_SIZE = MAX_STDERR_SIZE = MAX_CODE_SIZE = MAX_HTML_SIZE = MAX_MD_SIZE = 100000
 MAX_TEX_SIZE = 2000
+# Instead of truncating stdout, stderr, html or md output beyond those sizes (or
+# dropping it while output is throttled), a preview of MAX_SPILL_PREVIEW_SIZE
+# characters is shown and the full text is written to a spill file, which is
+# uploaded as a blob and linked from the cell when it is done.  Spill files are
+# limited to MAX_SPILL_SIZE bytes, since the hub doesn't save blobs over 12MB.
+MAX_SPILL_PREVIEW_SIZE = 2000
+MAX_SPILL_SIZE = 10000000
 
 # We import the notebook interact, which we will monkey patch below,
 # first, since importing later causes trouble in sage>=5.6.
 import sagenb.notebook.interact
 
 # Standard imports.
-import json, resource, shutil, signal, socket, struct, \
-       tempfile, time, traceback, pwd
+import atexit, collections, contextlib, cPickle, errno, fcntl, gc, json, logging, re, resource, select, shutil, signal, \
+       socket, struct, tempfile, threading, time, traceback, types, pwd, zlib
+import _multiprocessing   # for sendfd/recvfd, which Python 2's socket module lacks
 
 import sage_parsing, sage_salvus
 
@@ -69,14 +86,176 @@ def unicode8(s):
 
 LOGFILE = os.path.realpath(__file__)[:-3] + ".log"
 PID = os.getpid()
-def log(*args):
-    try:
-        debug_log = open(LOGFILE, 'a')
-        mesg = "%s: %s\n"%(PID,' '.join([unicode8(x) for x in args]))
-        debug_log.write(mesg)
-        debug_log.flush()
-    except:
-        log("an error writing a log message (ignoring)")
+
+class Logger(object):
+    """
+    The log file shared by the server and all of its forked children.
+
+    Calling the logger (log(...)) logs at INFO level; there are also
+    log.debug, log.info, log.warning and log.error.  The arguments are
+    converted with unicode8 and joined with spaces, but only if their level
+    is enabled; for arguments that are expensive to compute, check
+    log.enabled(level) first.
+
+    The file is opened once, and lines are buffered until there are
+    buffer_size bytes, a message at WARNING or above arrives, the oldest
+    buffered line is flush_interval seconds old (checked on each message,
+    or by a background thread if background=True), or the process exits.
+    If max_bytes is nonzero, the file is rotated to LOGFILE.1, ... when it
+    gets bigger than that.
+
+    Call log.flush() before forking, so buffered lines aren't written by
+    both processes, and log.after_fork() in the child.
+    """
+    def __init__(self, filename, level=logging.INFO, buffer_size=8192, flush_interval=1,
+                 max_bytes=0, backup_count=1, background=False):
+        self.filename = filename
+        self.level = level
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.background = background
+        self._file = None
+        self._buf = []
+        self._size = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+        if background:
+            self._start_thread()
+        atexit.register(self.flush)
+
+    LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+    def set_level(self, level):
+        """
+        Set the level, either as a number or as one of the names in
+        LEVELS (any case).  Raises ValueError for any other name.
+        """
+        if isinstance(level, basestring):
+            if level.upper() not in self.LEVELS:
+                raise ValueError("unknown log level '%s'"%level)
+            level = getattr(logging, level.upper())
+        self.level = level
+
+    def set_file(self, filename, truncate=False):
+        with self._lock:
+            self._flush()
+            self._close()
+            self.filename = filename
+            if truncate:
+                open(filename, 'w').close()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def __call__(self, *args):
+        self._log(logging.INFO, args)
+
+    def debug(self, *args):
+        self._log(logging.DEBUG, args)
+
+    def info(self, *args):
+        self._log(logging.INFO, args)
+
+    def warning(self, *args):
+        self._log(logging.WARNING, args)
+
+    def error(self, *args):
+        self._log(logging.ERROR, args)
+
+    def _log(self, level, args):
+        if level < self.level:
+            return
+        try:
+            mesg = u"%s: %s\n"%(PID, u' '.join([unicode8(x) for x in args]))
+        except Exception:
+            mesg = u"%s: (unable to format a log message)\n"%PID
+        with self._lock:
+            t = time.time()
+            if not self._buf:
+                self._oldest = t
+            self._buf.append(mesg)
+            self._size += len(mesg)
+            if (level >= logging.WARNING or self._size >= self.buffer_size or
+                      t - self._oldest >= self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buf:
+            return
+        data = u''.join(self._buf).encode('utf8', 'replace')
+        self._buf = []
+        self._size = 0
+        try:
+            if self._file is not None and self.max_bytes:
+                # another process may have rotated the file
+                try:
+                    if os.stat(self.filename).st_ino != os.fstat(self._file.fileno()).st_ino:
+                        self._close()
+                except OSError:
+                    self._close()
+            if self._file is None:
+                self._file = open(self.filename, 'a')
+            self._file.write(data)
+            self._file.flush()
+            if self.max_bytes and self._file.tell() > self.max_bytes:
+                self._rotate()
+        except Exception:
+            # there is nowhere to report errors about logging
+            self._close()
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+
+    def _rotate(self):
+        self._close()
+        if self.backup_count <= 0:
+            open(self.filename, 'w').close()
+            return
+        for i in reversed(range(1, self.backup_count)):
+            src = "%s.%s"%(self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%s"%(self.filename, i+1))
+        os.rename(self.filename, self.filename + ".1")
+
+    def start_background(self, flush_interval):
+        """
+        Flush every flush_interval seconds from a background thread, so
+        lines don't sit in the buffer while nothing else is logged.
+        """
+        self.flush_interval = flush_interval
+        self.background = True
+        self._start_thread()
+
+    def _start_thread(self):
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+        t = threading.Thread(target=run, name='log flush')
+        t.daemon = True
+        t.start()
+
+    def after_fork(self):
+        """
+        Call in a newly forked child: only the forking thread survives a
+        fork, and the lock may have been held by another one.
+        """
+        self._lock = threading.Lock()
+        if self.background:
+            self._start_thread()
+
+log = Logger(LOGFILE)
 
 # Determine the info object, if available.  There's no good reason
 # it wouldn't be available, unless a user explicitly deleted it, but
@@ -91,57 +270,217 @@ if 'base_url' not in INFO:
     INFO['base_url'] = ''
 
 
-# Configure logging
-#logging.basicConfig()
-#log = logging.getLogger('sage_server')
-#log.setLevel(logging.INFO)
-
 # A CoffeeScript version of this function is in misc_node.coffee.
 import hashlib
+def uuid_from_sha1(s):
+    """
+    Format the hex digest s of a sha1 hash as a uuid (version 4 layout).
+    """
+    # take 8 + low order 3 bits of hex number for the y position.
+    return '%s-%s-4%s-%x%s-%s'%(s[:8], s[8:12], s[12:15], (int(s[15],16)&0x3)|0x8, s[16:19], s[19:31])
+
 def uuidsha1(data):
+    return uuid_from_sha1(hashlib.sha1(data).hexdigest())
+
+# Files are hashed and sent in chunks of this many bytes, so the memory
+# used by salvus.file doesn't depend on the size of the file.
+BLOB_CHUNK_SIZE = 1048576
+
+def uuidsha1_file(f, chunk_size=BLOB_CHUNK_SIZE):
+    """
+    Return (uuid, size) for the contents of the open file f, hashing it
+    incrementally.  The file position is left at the end of the file.
+    """
     sha1sum = hashlib.sha1()
-    sha1sum.update(data)
-    s = sha1sum.hexdigest()
-    t = 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'
-    r = list(t)
-    j = 0
-    for i in range(len(t)):
-        if t[i] == 'x':
-            r[i] = s[j]; j += 1
-        elif t[i] == 'y':
-            # take 8 + low order 3 bits of hex number.
-            r[i] = hex( (int(s[j],16)&0x3) |0x8)[-1]; j += 1
-    return ''.join(r)
+    size = 0
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        sha1sum.update(data)
+        size += len(data)
+    return uuid_from_sha1(sha1sum.hexdigest()), size
+
+# Linux lets us tell the kernel that more data for the same frame follows, so
+# the length header and the payload go out in a single segment without first
+# concatenating them in Python.  (Python 2's socket module doesn't export it.)
+MSG_MORE = getattr(socket, 'MSG_MORE', 0x8000 if sys.platform.startswith('linux') else 0)
+
+# Payloads smaller than this are simply concatenated with their header; copying
+# a few kilobytes is cheaper than an extra system call.
+SEND_COPY_THRESHOLD = 65536
+
+# Receive buffers up to this size are kept and reused for the next message;
+# larger ones are released so one big blob doesn't pin memory for the session.
+RECV_BUFFER_KEEP = 1048576
+
+# msgpack is optional; it is only used if it is installed and the hub asks for it.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Once compression is negotiated, frames with a payload at least this big are
+# sent zlib compressed (if that makes them smaller).  Level 1 is much faster
+# than the default and gets most of the gain on output and graphics messages.
+COMPRESS_THRESHOLD = 4096
+COMPRESS_LEVEL = 1
+
+# Separators for json.dumps without the spaces after ',' and ':'.
+JSON_SEPARATORS = (',', ':')
 
 # A tcp connection with support for sending various types of messages, especially JSON.
+#
+# Every message is a frame: a 4-byte big endian length, a type character and the
+# payload.  The types are
+#
+#    'j' -- a JSON message
+#    'b' -- a blob: 36 character uuid followed by the data
+#    'm' -- a msgpack message       (only if negotiated, see negotiate)
+#    'z' -- zlib compressed frame, whose uncompressed form is the type
+#           character and payload of one of the above (only if negotiated)
+#
 class ConnectionJSON(object):
     def __init__(self, conn):
         assert not isinstance(conn, ConnectionJSON)  # avoid common mistake -- conn is supposed to be from socket.socket...
         self._conn = conn
+        self._rbuf = bytearray(4096)
+        self._lock = threading.Lock()   # output may also be flushed from the OutputFlusher thread
+        self._compress_threshold = None
+        self._msgpack = False
+        # totals sent on this connection (see ResourceUsage)
+        self.frames_sent = self.blobs_sent = self.bytes_sent = 0
+
+    def negotiate(self, params):
+        """
+        Choose the encoding of the messages we send from the params of a
+        start_session message, and return a description of the choice to
+        include in the session description (None if nothing changes).
+        The choice takes effect once it is passed to set_wire.
+
+        A hub that can decode the optional frame types lists them in
+        params['accept'], e.g., {'accept':['zlib', 'msgpack']}.  Hubs that
+        don't are only ever sent 'j' and 'b' frames.
+        """
+        accept = params.get('accept') if isinstance(params, dict) else None
+        if not isinstance(accept, list):
+            return None
+        wire = {}
+        if 'zlib' in accept:
+            wire['compress'] = 'zlib'
+            wire['compress_threshold'] = COMPRESS_THRESHOLD
+        if 'msgpack' in accept and msgpack is not None:
+            wire['encoding'] = 'msgpack'
+        return wire or None
+
+    def set_wire(self, wire):
+        """
+        Start sending messages as described by wire (see negotiate).
+        """
+        wire = wire or {}
+        if wire.get('compress') == 'zlib':
+            self._compress_threshold = wire.get('compress_threshold', COMPRESS_THRESHOLD)
+        else:
+            self._compress_threshold = None
+        self._msgpack = wire.get('encoding') == 'msgpack' and msgpack is not None
 
     def close(self):
         self._conn.close()
 
-    def _send(self, s):
-        length_header = struct.pack(">L", len(s))
-        self._conn.send(length_header + s)
+    def _send(self, *parts, **kwds):
+        """
+        Send one frame whose payload is the concatenation of the given
+        strings.  The length header and all but the last part are small;
+        they are written together, and a large last part is then written
+        directly from its own buffer in the same TCP segment (MSG_MORE).
+        Pass blob=True if the frame is a blob, to count it as one.
+        """
+        body = parts[-1]
+        head = ''.join(parts[:-1])
+        head = struct.pack(">L", len(head) + len(body)) + head
+        with self._lock:
+            self.frames_sent += 1
+            if kwds.get('blob'):
+                self.blobs_sent += 1
+            self.bytes_sent += len(head) + len(body)
+            if len(body) < SEND_COPY_THRESHOLD:
+                self._conn.sendall(head + body)
+            else:
+                self._conn.sendall(head, MSG_MORE)
+                self._conn.sendall(body)
+
+    def _compress(self, typ, payload):
+        """
+        Return the (type, payload) to send for a frame: a 'z' frame if
+        compression was negotiated and pays off, otherwise the frame itself.
+        """
+        if self._compress_threshold is not None and len(payload) >= self._compress_threshold:
+            c = zlib.compressobj(COMPRESS_LEVEL)
+            z = c.compress(typ) + c.compress(payload) + c.flush()
+            if len(z) < len(payload):
+                return 'z', z
+        return typ, payload
+
+    def encode(self, m):
+        """
+        Return the (type, payload) of the frame send_json sends for m.
+        """
+        if self._msgpack:
+            return self._compress('m', msgpack.packb(m))
+        return self._compress('j', json.dumps(m, separators=JSON_SEPARATORS))
 
     def send_json(self, m):
-        m = json.dumps(m)
-        log(u"sending message '", truncate_text(m, 256), u"'")
-        self._send('j' + m)
+        typ, s = self.encode(m)
+        if log.enabled(logging.DEBUG):
+            log.debug(u"sending message '", truncate_text(s if typ == 'j' else repr(m), 256), u"'")
+        self._send(typ, s)
 
     def send_blob(self, blob):
         s = uuidsha1(blob)
-        self._send('b' + s + blob)
+        if self._compress_threshold is not None and len(blob) >= self._compress_threshold:
+            self._send(*self._compress('b', s + blob), blob=True)
+        else:
+            self._send('b', s, blob, blob=True)
         return s
 
-    def send_file(self, filename):
+    def send_file(self, filename, chunk_size=BLOB_CHUNK_SIZE, sha1=None):
+        """
+        Send the contents of a file as a blob and return its uuid.
+
+        The file is read twice in chunks: once to compute the sha1 (which
+        goes in front of the blob) and once to stream it into the frame, so
+        only chunk_size bytes are ever held in memory.  On the wire this is
+        exactly the same message as send_blob(open(filename).read()).
+        If the caller already knows the uuidsha1 of the file, it may pass it
+        as sha1, and the hashing pass is skipped.
+        """
         log("sending file '%s'"%filename)
         f = open(filename, 'rb')
-        data = f.read()
-        f.close()
-        return self.send_blob(data)
+        try:
+            if sha1 is None:
+                s, size = uuidsha1_file(f, chunk_size)
+            else:
+                s, size = sha1, os.fstat(f.fileno()).st_size
+            if size + 37 >= 2**32:
+                raise ValueError("file '%s' is too large to send as a blob"%filename)
+            f.seek(0)
+            with self._lock:
+                self.frames_sent += 1; self.blobs_sent += 1
+                self.bytes_sent += size + 41
+                self._conn.sendall(struct.pack(">L", size + 37) + 'b' + s, MSG_MORE)
+                while size > 0:
+                    data = f.read(min(chunk_size, size))
+                    if not data:
+                        # The file was truncated after we hashed it.  The frame length is
+                        # already sent, so pad it out to keep the connection in sync; the
+                        # blob will simply have the wrong content.
+                        log.warning("file '%s' shrank while sending it"%filename)
+                        data = '\0'*min(chunk_size, size)
+                    size -= len(data)
+                    self._conn.sendall(data, MSG_MORE if size else 0)
+        finally:
+            f.close()
+        return s
 
     def _recv(self, n):
         #print "_recv(%s)"%n
@@ -157,29 +496,264 @@ class ConnectionJSON(object):
                     raise
         raise EOFError
 
+    def _recv_into(self, view):
+        """
+        Fill the writable memoryview view completely from the socket.
+        """
+        while len(view):
+            for i in range(20):
+                try:
+                    k = self._conn.recv_into(view)
+                    break
+                except socket.error as (errno, msg):
+                    if errno != 4:
+                        raise
+            else:
+                raise EOFError
+            if k == 0:
+                raise EOFError
+            view = view[k:]
+
+    def _recv_payload(self, n):
+        """
+        Receive exactly n bytes.  Small messages almost always arrive in
+        one piece; otherwise the rest is read straight into a reusable
+        buffer instead of growing a string with +=, which is quadratic.
+        """
+        s = self._recv(n)
+        if len(s) == n:
+            return s
+        if len(s) == 0:
+            raise EOFError
+        buf = self._rbuf if len(self._rbuf) >= n else bytearray(n)
+        view = memoryview(buf)
+        view[:len(s)] = s
+        self._recv_into(view[len(s):n])
+        if n <= RECV_BUFFER_KEEP:
+            self._rbuf = buf
+        return view[:n].tobytes()
+
     def recv(self):
         n = self._recv(4)
         if len(n) < 4:
-            raise EOFError
-        n = struct.unpack('>L', n)[0]   # big endian 32 bits
-        s = self._recv(n)
-        while len(s) < n:
-            t = self._recv(n - len(s))
-            if len(t) == 0:
+            if len(n) == 0:
                 raise EOFError
-            s += t
+            n += self._recv_payload(4 - len(n))
+        n = struct.unpack('>L', n)[0]   # big endian 32 bits
+        return self.decode(self._recv_payload(n))
 
+    def decode(self, s):
+        """
+        Return the (type, message) of the received frame payload s.
+        """
         if s[0] == 'j':
             try:
                 return 'json', json.loads(s[1:])
             except Exception, msg:
-                log("Unable to parse JSON '%s'"%s[1:])
+                log.error("Unable to parse JSON '%s'"%s[1:])
                 raise
 
         elif s[0] == 'b':
             return 'blob', s[1:]
+
+        elif s[0] == 'z':
+            return self.decode(zlib.decompress(buffer(s, 1)))
+
+        elif s[0] == 'm' and msgpack is not None:
+            return 'json', msgpack.unpackb(buffer(s, 1))
+
         raise ValueError("unknown message type '%s'"%s[0])
 
+# Maximum number of blobs remembered by blob_cache.
+BLOB_CACHE_SIZE = 1024
+
+class BlobCache(object):
+    """
+    A bounded LRU index of the blobs that the hub has acknowledged saving
+    during this session, so showing a file with the same content again only
+    has to send a reference to it, not the data.
+
+    Since every session is its own process, the cache is naturally
+    per-session.  A blob whose ttl is more than half used up is not
+    reused, since it may expire while the worksheet still refers to it.
+
+    The sha1 of a file is also remembered by its path, size, mtime and
+    inode, so an unchanged file isn't even hashed again.
+    """
+    def __init__(self, max_size=BLOB_CACHE_SIZE):
+        self.max_size = max_size
+        self._acked = collections.OrderedDict()   # sha1 --> (time acked, ttl)
+        self._hashes = collections.OrderedDict()  # (path, size, mtime, ino) --> sha1
+        self.hits = 0
+        self.misses = 0
+        self.hashes_skipped = 0
+
+    def __repr__(self):
+        return "BlobCache(%s)"%self.stats()
+
+    def stats(self):
+        return {'size':len(self._acked), 'max_size':self.max_size, 'hits':self.hits,
+                'misses':self.misses, 'hashes_skipped':self.hashes_skipped}
+
+    def _add(self, d, key, val):
+        if key in d:
+            del d[key]
+        d[key] = val
+        while len(d) > self.max_size:
+            d.popitem(last=False)
+
+    def file_uuid(self, filename):
+        """
+        Return the uuidsha1 of the contents of the given file.
+        """
+        st = os.stat(filename)
+        key = (os.path.abspath(filename), st.st_size, st.st_mtime, st.st_ino)
+        s = self._hashes.get(key)
+        if s is not None:
+            self.hashes_skipped += 1
+        else:
+            f = open(filename, 'rb')
+            try:
+                s = uuidsha1_file(f)[0]
+            finally:
+                f.close()
+        self._add(self._hashes, key, s)
+        return s
+
+    def lookup(self, sha1):
+        """
+        If the blob with the given sha1 was saved by the hub and is still
+        good to use, return its remaining ttl (0 = permanent); otherwise,
+        return None.  Counts a hit or miss.
+        """
+        v = self._acked.get(sha1)
+        if v is not None:
+            acked, ttl = v
+            if not ttl:
+                remaining = 0
+            else:
+                remaining = acked + ttl - time.time()
+                if remaining < ttl/2.0:
+                    remaining = None
+            if remaining is not None:
+                self.hits += 1
+                self._add(self._acked, sha1, v)
+                return remaining
+            del self._acked[sha1]
+        self.misses += 1
+        return None
+
+    def acknowledged(self, mesg):
+        """
+        Record a save_blob message from the hub.
+        """
+        if 'error' not in mesg:
+            self._add(self._acked, mesg['sha1'], (time.time(), mesg.get('ttl', 0)))
+
+blob_cache = BlobCache()
+
+# Maximum number of blocks whose preparsed and compiled code is remembered,
+# and the length (in characters) of the longest block that is.
+CODE_CACHE_SIZE = 512
+CODE_CACHE_MAX_BLOCK = 100000
+
+class CodeCache(object):
+    """
+    A bounded LRU cache of the work done on a block of code before it
+    runs: preparsing it (keyed by the block and the state of the
+    preparser) and compiling it (keyed by the preparsed block).  A block
+    that is executed again, e.g., the body of an interact on every
+    change of a control, skips both.  Likewise, a chain of code
+    decorators is preparsed and compiled once (see decorators).
+
+    Sessions forked from the server (or a zygote) start with the blocks
+    it ran, e.g., the initialization cells of a zygote.
+    """
+    def __init__(self, max_size=CODE_CACHE_SIZE, max_block=CODE_CACHE_MAX_BLOCK):
+        self.max_size = max_size
+        self.max_block = max_block
+        self._preparsed = collections.OrderedDict()   # (block, preparser state) --> preparsed block
+        self._compiled = collections.OrderedDict()    # preparsed block --> code object
+        self._decorators = collections.OrderedDict()  # (code decorators, preparse) --> code objects
+        self.preparse_hits = self.preparse_misses = 0
+        self.compile_hits = self.compile_misses = 0
+        self.decorator_hits = self.decorator_misses = 0
+
+    def __repr__(self):
+        return "CodeCache(%s)"%self.stats()
+
+    def stats(self):
+        return {'size':len(self._compiled), 'max_size':self.max_size,
+                'preparse_hits':self.preparse_hits, 'preparse_misses':self.preparse_misses,
+                'compile_hits':self.compile_hits, 'compile_misses':self.compile_misses,
+                'decorator_hits':self.decorator_hits, 'decorator_misses':self.decorator_misses}
+
+    def _get(self, d, key):
+        v = d.get(key)
+        if v is not None:
+            del d[key]
+            d[key] = v
+        return v
+
+    def _add(self, d, key, val):
+        d[key] = val
+        while len(d) > self.max_size:
+            d.popitem(last=False)
+
+    def preparse(self, block):
+        """
+        Return sage_parsing.preparse_code(block).
+        """
+        if len(block) > self.max_block:
+            self.preparse_misses += 1
+            return sage_parsing.preparse_code(block)
+        key = (block, sage_parsing.preparser_state())
+        v = self._get(self._preparsed, key)
+        if v is not None:
+            self.preparse_hits += 1
+            return v
+        self.preparse_misses += 1
+        v = sage_parsing.preparse_code(block)
+        self._add(self._preparsed, key, v)
+        return v
+
+    def compile(self, block):
+        """
+        Return compile(block+'\\n', '', 'single').
+        """
+        if len(block) > self.max_block:
+            self.compile_misses += 1
+            return compile(block+'\n', '', 'single')
+        v = self._get(self._compiled, block)
+        if v is not None:
+            self.compile_hits += 1
+            return v
+        self.compile_misses += 1
+        v = compile(block+'\n', '', 'single')
+        self._add(self._compiled, block, v)
+        return v
+
+    def decorators(self, code_decorators, preparse=True):
+        """
+        Return the list of code objects that evaluate the expressions in
+        the list code_decorators (preparsed first, if preparse is true);
+        see Salvus.execute_with_code_decorators.  They are evaluated on
+        each use, so that they are looked up in the namespace as it is.
+        """
+        key = (tuple(code_decorators), preparse, preparse and sage_parsing.preparser_state())
+        v = self._get(self._decorators, key)
+        if v is not None:
+            self.decorator_hits += 1
+            return v
+        self.decorator_misses += 1
+        if preparse:
+            code_decorators = map(self.preparse, code_decorators)
+        v = [compile(d, '', 'eval') for d in code_decorators]
+        self._add(self._decorators, key, v)
+        return v
+
+code_cache = CodeCache()
+
 def truncate_text(s, max_size):
     if len(s) > max_size:
         return s[:max_size] + "[...]"
@@ -198,8 +772,32 @@ class Message(object):
     def start_session(self):
         return self._new('start_session')
 
-    def session_description(self, pid):
-        return self._new('session_description', {'pid':pid})
+    def pong(self, id=None):
+        return self._new('pong', locals())
+
+    def sage_server_status(self, id=None, info=None):
+        return self._new('sage_server_status', locals())
+
+    def session_stats(self, id=None, stats=None):
+        return self._new('session_stats', locals())
+
+    def session_description(self, pid, wire=None, zygote=None, restored=None):
+        m = self._new('session_description', {'pid':pid})
+        if wire is not None:
+            m['wire'] = wire
+        if zygote is not None:
+            m['zygote'] = zygote
+        if restored is not None:
+            m['restored'] = restored
+        return m
+
+    def checkpoint_namespace(self, id=None, path=None, max_size=None, saved=None, skipped=None, size=None, error=None):
+        m = self._new('checkpoint_namespace', {'id':id, 'path':path})
+        for k, v in [('max_size', max_size), ('saved', saved), ('skipped', skipped),
+                     ('size', size), ('error', error)]:
+            if v is not None:
+                m[k] = v
+        return m
 
     def send_signal(self, pid, signal=signal.SIGINT):
         return self._new('send_signal', locals())
@@ -232,7 +830,8 @@ class Message(object):
                show         = None,
                auto         = None,
                events       = None,
-               clear        = None):
+               clear        = None,
+               stats        = None):
         m = self._new('output')
         m['id'] = id
         t = truncate_text
@@ -255,7 +854,7 @@ class Message(object):
         if coffeescript is not None: m['coffeescript'] = coffeescript
         if interact is not None: m['interact'] = interact
         if d3 is not None: m['d3'] = d3
-        if obj is not None: m['obj'] = json.dumps(obj)
+        if obj is not None: m['obj'] = json.dumps(obj, separators=JSON_SEPARATORS)
         if file is not None: m['file'] = file    # = {'filename':..., 'uuid':...}
         if done is not None: m['done'] = done
         if once is not None: m['once'] = once
@@ -264,6 +863,7 @@ class Message(object):
         if auto is not None: m['auto'] = auto
         if events is not None: m['events'] = events
         if clear is not None: m['clear'] = clear
+        if stats is not None: m['stats'] = stats
         return m
 
     def introspect_completions(self, id, completions, target):
@@ -327,105 +927,519 @@ def client1(port, hostname):
     conn.send_json(message.terminate_session())
     print "\nExiting Sage client."
 
-class BufferedOutputStream(object):
-    def __init__(self, f, flush_size=4096, flush_interval=.1):
-        self._f = f
-        self._buf = ''
+def output_size(mesg):
+    """
+    The number of characters of content in an output message, which is
+    what the output throttle counts.
+    """
+    n = 0
+    for v in mesg.itervalues():
+        if isinstance(v, basestring):
+            n += len(v)
+        elif isinstance(v, dict):
+            n += sum(len(x) for x in v.itervalues() if isinstance(x, basestring))
+    return n
+
+class OutputThrottle(object):
+    """
+    Token buckets limiting the rate of output messages and characters sent
+    by this session; the limits are the OUTPUT constants at the top of
+    this file, read from the sage_server module each time, so they can be
+    changed from a worksheet.
+
+    A message may be sent when there is at least one message token and
+    the character bucket isn't in debt, so a single large message is never
+    refused outright; it just delays what comes after it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = None
+        self._chars = None
+        self._time = time.time()
+        self._cell_messages = self._cell_chars = 0
+        self.dropped_messages = self.dropped_chars = 0
+        self.throttled = 0
+
+    def __repr__(self):
+        return "OutputThrottle(%s)"%self.stats()
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {'messages':self._messages, 'chars':self._chars, 'throttled':self.throttled,
+                    'dropped_messages':self.dropped_messages, 'dropped_chars':self.dropped_chars}
+
+    def _refill(self):
+        import sage_server
+        t = time.time()
+        dt = t - self._time
+        self._time = t
+        if self._messages is None:
+            self._messages = sage_server.MAX_OUTPUT_MESSAGES
+            self._chars = sage_server.MAX_OUTPUT_BURST_SIZE
+        else:
+            self._messages = min(sage_server.MAX_OUTPUT_MESSAGES,
+                                 self._messages + dt*sage_server.OUTPUT_MESSAGES_PER_SECOND)
+            self._chars = min(sage_server.MAX_OUTPUT_BURST_SIZE,
+                              self._chars + dt*sage_server.OUTPUT_CHARS_PER_SECOND)
+
+    def _wait_time(self):
+        import sage_server
+        return max(0, (1 - self._messages)/float(sage_server.OUTPUT_MESSAGES_PER_SECOND),
+                      -self._chars/float(sage_server.OUTPUT_CHARS_PER_SECOND))
+
+    def wait_time(self):
+        """
+        Return how many seconds until a message can be sent (0 if it can now).
+        """
+        with self._lock:
+            self._refill()
+            return self._wait_time()
+
+    def take(self, size):
+        """
+        Consume tokens for a message with size characters and return True,
+        or return False if throttled.
+        """
+        with self._lock:
+            self._refill()
+            if self._wait_time() > 0:
+                self.throttled += 1
+                return False
+            self._messages -= 1
+            self._chars -= size
+            return True
+
+    def consume(self, size):
+        """
+        Consume tokens for a message that is sent regardless.
+        """
+        with self._lock:
+            self._refill()
+            self._messages -= 1
+            self._chars -= size
+
+    def drop(self, size, messages=1):
+        with self._lock:
+            self._cell_messages += messages; self.dropped_messages += messages
+            self._cell_chars += size; self.dropped_chars += size
+
+    def cell_summary(self):
+        """
+        Return a message describing the output dropped since the last call,
+        or None if nothing was dropped.
+        """
+        with self._lock:
+            m, c = self._cell_messages, self._cell_chars
+            self._cell_messages = self._cell_chars = 0
+        if not m and not c:
+            return None
+        v = []
+        if m:
+            v.append("%s output message%s"%(m, 's' if m != 1 else ''))
+        if c:
+            v.append("%s character%s"%(c, 's' if c != 1 else ''))
+        return "\nOutput was throttled; dropped %s (see sage_server.OUTPUT_CHARS_PER_SECOND, etc.)\n"%' and '.join(v)
+
+output_throttle = OutputThrottle()
+
+class OutputFlusher(object):
+    """
+    A daemon thread that flushes the current cell's OutputBuffer once its
+    oldest unsent output is flush_interval old, so output printed right
+    before a long silent computation still shows up promptly.  It sleeps
+    whenever nothing is buffered.  Use output_flusher() to get the one
+    for this process.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._buffer = None
+        self._deadline = None
+        self.pid = os.getpid()
+        t = threading.Thread(target=self._run, name='output flusher')
+        t.daemon = True
+        t.start()
+
+    def schedule(self, buffer, deadline):
+        with self._cond:
+            self._buffer = buffer
+            self._deadline = deadline
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._buffer is None:
+                    self._cond.wait()
+                delay = self._deadline - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                buffer, self._buffer = self._buffer, None
+            try:
+                buffer.flush()
+            except Exception, err:
+                log.error("error flushing output -- %s"%err)
+
+_output_flusher = None
+def output_flusher():
+    global _output_flusher
+    if _output_flusher is None or _output_flusher.pid != os.getpid():
+        # threads don't survive a fork, so each process needs its own
+        _output_flusher = OutputFlusher()
+    return _output_flusher
+
+class OutputBuffer(object):
+    """
+    The stdout and stderr output of a cell that hasn't been sent yet.
+
+    Writes to both streams are kept, in order, as a list of chunks and
+    sent by flush as a single output message with both stdout and stderr.
+    The client shows the stdout of a message before its stderr, so a
+    flush only splits into several messages where stderr output is
+    followed by stdout output.
+
+    If an OutputThrottle is given, flushes wait until it allows another
+    message.  Output that would make the buffer larger than max_pending
+    characters is dropped; normally the buffer is flushed long before
+    that, so this only matters while throttled or for huge writes.  If
+    spill is given, instead all unsent output is passed to it, in order,
+    and only a preview of it is kept, followed by a note when sent.
+
+    INPUT:
+
+    - ``send`` -- function send(stdout=..., stderr=..., done=...)
+    - ``flush_size`` -- flush once this many characters are buffered
+    - ``flush_interval`` -- flush at most this many seconds after a write
+    - ``throttle`` -- None or an OutputThrottle
+    - ``max_pending`` -- when throttled, drop output beyond this many characters
+    - ``spill`` -- None or a function spill(kind, output) that saves output
+      instead of dropping it (kind is 'txt'; see OutputSpill)
+    - ``spill_preview`` -- number of characters kept as a preview of spilled output
+    """
+    def __init__(self, send, flush_size=4096, flush_interval=.1, throttle=None, max_pending=None,
+                 spill=None, spill_preview=2000):
+        self._send = send
+        self._spill = spill
+        self._spill_preview = spill_preview
+        self._spilled = 0   # characters spilled since output was last sent
         self._flush_size = flush_size
         self._flush_interval = flush_interval
-        self.reset()
+        self._throttle = throttle
+        self._max_pending = max_pending
+        self._chunks = []   # list of (is_stderr, string)
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def write(self, is_stderr, output, force=False):
+        with self._lock:
+            if self._spilled and not force:
+                self._spill('txt', output)
+                self._spilled += len(output)
+                return
+            if (not force and self._max_pending is not None and
+                      self._size + len(output) > self._max_pending):
+                if self._spill is not None:
+                    self._spill_pending(is_stderr, output)
+                    return
+                keep = max(0, self._max_pending - self._size)
+                if self._throttle is not None:
+                    self._throttle.drop(len(output) - keep, messages=0)
+                output = output[:keep]
+                if not output:
+                    return
+            if not self._chunks and self._flush_interval is not None:
+                output_flusher().schedule(self, time.time() + self._flush_interval)
+            self._chunks.append((is_stderr, output))
+            self._size += len(output)
+            if self._size >= self._flush_size:
+                self.flush()
+
+    def _spill_pending(self, is_stderr, output):
+        # Spill everything not sent yet, and keep the first spill_preview characters.
+        chunks = self._chunks + [(is_stderr, output)]
+        preview, n = [], 0
+        for e, text in chunks:
+            self._spill('txt', text)
+            if n < self._spill_preview:
+                preview.append((e, text[:self._spill_preview - n]))
+                n += len(preview[-1][1])
+        self._spilled = self._size + len(output) - n
+        if not self._chunks and self._flush_interval is not None:
+            output_flusher().schedule(self, time.time() + self._flush_interval)
+        self._chunks = preview
+        self._size = n
+
+    def pending(self, is_stderr):
+        """
+        Return True if there is unsent output for the given stream.
+        """
+        with self._lock:
+            return any(e == is_stderr for e, _ in self._chunks)
+
+    def flush(self, done=False, force=False):
+        with self._lock:
+            if not self._chunks and not done:
+                # no point in sending an empty message
+                return
+            if not done and not force and self._throttle is not None:
+                wait = self._throttle.wait_time()
+                if wait > 0:
+                    # keep coalescing until the throttle allows another message
+                    output_flusher().schedule(self, time.time() + wait)
+                    return
+            chunks, self._chunks, self._size = self._chunks, [], 0
+            if self._spilled:
+                chunks.append((False, u"\n[... %s more characters in output.txt]\n"%self._spilled))
+                self._spilled = 0
+            # group into runs of stdout followed by stderr
+            messages = []
+            for is_stderr, output in chunks:
+                if not messages or (not is_stderr and messages[-1][1]):
+                    messages.append(([], []))
+                messages[-1][is_stderr].append(output)
+            if not messages:
+                messages.append(([], []))
+            for i, (stdout, stderr) in enumerate(messages):
+                self._send(stdout=''.join(stdout), stderr=''.join(stderr),
+                           done=done and i == len(messages)-1)
+
+class BufferedOutputStream(object):
+    """
+    File-like object for sys.stdout or sys.stderr that writes to an
+    OutputBuffer shared by both.
+    """
+    def __init__(self, buffer, is_stderr=False):
+        self._buffer = buffer
+        self._is_stderr = is_stderr
 
     def reset(self):
-        self._last_flush_time = time.time()
+        # flushing is driven by the OutputFlusher timer now
+        pass
 
     def fileno(self):
         return 0
 
     def write(self, output):
-        self._buf += output
-        #self.flush()
-        t = time.time()
-        if ((len(self._buf) >= self._flush_size) or
-                  (t - self._last_flush_time >= self._flush_interval)):
-            self.flush()
-            self._last_flush_time = t
+        self._buffer.write(self._is_stderr, output)
 
     def flush(self, done=False):
-        if not self._buf and not done:
-            # no point in sending an empty message
-            return
-        self._f(self._buf, done=done)
-        self._buf = ''
+        self._buffer.flush(done=done)
+
 
+class OutputSpill(object):
+    """
+    Output of a cell that was too large to send in output messages, in
+    temporary files of at most max_size bytes: one for stdout and stderr
+    ('txt'), and one each for html and md.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._dir = None
+        self._files = {}   # kind --> [file, bytes written, characters dropped]
+
+    def __len__(self):
+        return len(self._files)
+
+    def write(self, kind, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf8')
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp()
+        if kind not in self._files:
+            self._files[kind] = [open(os.path.join(self._dir, 'output.%s'%kind), 'wb'), 0, 0]
+        v = self._files[kind]
+        keep = max(0, min(len(text), self._max_size - v[1]))
+        if keep:
+            v[0].write(text[:keep])
+            v[1] += keep
+        v[2] += len(text) - keep
+
+    def files(self):
+        """
+        Close the spill files and return a list of their paths.
+        """
+        paths = []
+        for kind, (f, size, dropped) in sorted(self._files.iteritems()):
+            if dropped:
+                f.write("\n[... %s more bytes not saved]\n"%dropped)
+            f.close()
+            paths.append(f.name)
+        return paths
+
+    def remove(self):
+        for f, _, _ in self._files.itervalues():
+            f.close()
+        self._files = {}
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+def code_names(code, names=None):
+    """
+    Return the set of names used by the code object code, including in
+    the functions and classes it defines.
+    """
+    if names is None:
+        names = set()
+    names.update(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            code_names(c, names)
+    return names
 
-# This will *have* to be re-done using Cython for speed.
 class Namespace(dict):
+    """
+    The global namespace of a session, which can be observed: see on.
+
+    Assignments made by running code go straight to the dict unless
+    something observes the namespace or names are lazy (see lazy); only
+    then is the namespace an ObservedNamespace, which records the names
+    assigned or deleted.  Observers are called by notify, once per name
+    and with its final value, which Salvus.execute does after each
+    block of code.
+    """
     def __init__(self, x):
         self._on_change = {}
         self._on_del = {}
+        self._lazy = {}
+        self._events = {}   # name --> 'change' or 'del', since the last notify
         dict.__init__(self, x)
 
+    def _observe(self):
+        # Switch between the plain class (assignments are dict stores done
+        # in C) and ObservedNamespace, depending on what must be tracked.
+        if self._on_change or self._on_del or self._lazy:
+            self.__class__ = ObservedNamespace
+        else:
+            self.__class__ = Namespace
+
     def on(self, event, x, f):
+        """
+        Call f when x changes (f(value)) or is deleted (f()), where event is
+        'change' or 'del'.  If x is None, f is called for every name,
+        with the name as the first argument.
+        """
         if event == 'change':
-            if x not in self._on_change:
-                self._on_change[x] = []
-            self._on_change[x].append(f)
+            handlers = self._on_change
         elif event == 'del':
-            if x not in self._on_del:
-                self._on_del[x] = []
-            self._on_del[x].append(f)
+            handlers = self._on_del
+        else:
+            raise ValueError("event must be 'change' or 'del'")
+        handlers.setdefault(x, []).append(f)
+        self._observe()
 
     def remove(self, event, x, f):
-        if event == 'change' and self._on_change.has_key(x):
-            v = self._on_change[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_change[x]
-        elif event == 'del' and self._on_del.has_key(x):
-            v = self._on_del[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_del[x]
+        """
+        Stop calling f for the given event and x (see on).
+        """
+        handlers = self._on_change if event == 'change' else self._on_del if event == 'del' else {}
+        v = handlers.get(x)
+        if v is not None:
+            try:
+                v.remove(f)
+            except ValueError:
+                pass
+            if not v:
+                del handlers[x]
+        self._observe()
+
+    def notify(self):
+        """
+        Call the observers of the names assigned or deleted since the last
+        call.
+        """
+        if not self._events:
+            return
+        events, self._events = self._events, {}
+        for x, event in events.iteritems():
+            try:
+                if event == 'change':
+                    if not dict.__contains__(self, x):
+                        continue
+                    y = dict.__getitem__(self, x)
+                    for f in self._on_change.get(x, ()):
+                        f(y)
+                    for f in self._on_change.get(None, ()):
+                        f(x, y)
+                else:
+                    for f in self._on_del.get(x, ()):
+                        f()
+                    for f in self._on_del.get(None, ()):
+                        f(x)
+            except Exception, mesg:
+                print mesg
+
+    def lazy(self, x, load):
+        """
+        Bind x to the value returned by load() the first time code that
+        uses x runs (see load_lazy), instead of now.  Any current value
+        of x is removed.
+        """
+        if dict.__contains__(self, x):
+            dict.__delitem__(self, x)
+        self._lazy[x] = load
+        self._observe()
+        sage_parsing.namespace_changed()   # x is still completed
+
+    def lazy_names(self):
+        """
+        Return the list of names that are lazy (see lazy) and not bound yet.
+        """
+        return list(self._lazy)
+
+    def load_lazy(self, code=None, names=None):
+        """
+        Bind the lazy names (see lazy) that the compiled code uses, or
+        that are in the list names, or all of them if neither is given.
+        Names that fail to load are reported on stderr and stay unbound.
+        """
+        if not self._lazy:
+            return
+        if code is not None:
+            names = code_names(code).intersection(self._lazy)
+        elif names is not None:
+            names = set(names).intersection(self._lazy)
+        else:
+            names = list(self._lazy)
+        for x in names:
+            load = self._lazy.pop(x)
+            try:
+                self[x] = load()
+            except Exception, err:
+                sys.stderr.write("Unable to restore '%s' -- %s\n"%(x, err))
+        self._observe()
 
+    def set(self, x, y, do_not_trigger=None):
+        """
+        Set x to y and call the observers of x right away, except those
+        in the list do_not_trigger.
+        """
+        dict.__setitem__(self, x, y)
+        if self._lazy:
+            self._lazy.pop(x, None)
+        if do_not_trigger is None:
+            do_not_trigger = []
+        for f in self._on_change.get(x, ()):
+            if f not in do_not_trigger:
+                f(y)
+        for f in self._on_change.get(None, ()):
+            f(x, y)
+
+class ObservedNamespace(Namespace):
+    """
+    A Namespace that something observes: assignments and deletions are
+    recorded for notify.  See Namespace._observe.
+    """
     def __setitem__(self, x, y):
         dict.__setitem__(self, x, y)
-        try:
-            if self._on_change.has_key(x):
-                for f in self._on_change[x]:
-                    f(y)
-            if self._on_change.has_key(None):
-                for f in self._on_change[None]:
-                    f(x, y)
-        except Exception, mesg:
-            print mesg
+        if self._lazy:
+            self._lazy.pop(x, None)
+        self._events[x] = 'change'
 
     def __delitem__(self, x):
-        try:
-            if self._on_del.has_key(x):
-                for f in self._on_del[x]:
-                    f()
-            if self._on_del.has_key(None):
-                for f in self._on_del[None]:
-                    f(x)
-        except Exception, mesg:
-            print mesg
         dict.__delitem__(self, x)
-
-    def set(self, x, y, do_not_trigger=None):
-        dict.__setitem__(self, x, y)
-        if self._on_change.has_key(x):
-            if do_not_trigger is None:
-                do_not_trigger = []
-            for f in self._on_change[x]:
-                if f not in do_not_trigger:
-                    f(y)
-        if self._on_change.has_key(None):
-            for f in self._on_change[None]:
-                f(x,y)
+        self._events[x] = 'del'
 
 class TemporaryURL:
     def __init__(self, url, ttl):
@@ -438,35 +1452,182 @@ class TemporaryURL:
 
 namespace = Namespace({})
 
-class Salvus(object):
-    """
-    Cell execution state object and wrapper for access to special SageMathCloud functionality.
+#########################################################
+# Checkpoints: the variables of a session saved to disk, so that
+# a new session can bring them back after an idle one is killed.
+#
+# A checkpoint file is the compressed pickles of the variables one
+# after another, then a JSON index {'version':1, 'names':{name:entry}},
+# then the offset of the index as 8 bytes (big endian).  An entry is
+# {'offset':..., 'size':...} or, for a module, {'module':name}.
+#########################################################
 
-    An instance of this object is created each time you execute a cell.  It has various methods
-    for sending different types of output messages, links to files, etc.
+# Maximum size in bytes of the pickled variables in a checkpoint;
+# change with "import sage_server; sage_server.CHECKPOINT_MAX_SIZE = ...".
+CHECKPOINT_MAX_SIZE = 100*2**20
 
-    OUTPUT LIMITATIONS -- There is an absolute limit on the number of messages output for a given
-    cell, and also the size of the output message for each cell.  You can access or change
-    those limits dynamically in a worksheet as follows by viewing or changing any of the
-    following variables::
+# Names that belong to the session rather than to the user's computation.
+CHECKPOINT_EXCLUDE = frozenset(['salvus', 'smc', 'require', 'sage_salvus'])
 
-        import sage_server
-        sage_server.MAX_STDOUT_SIZE   # max length of each stdout output message
-        sage_server.MAX_STDERR_SIZE   # max length of each stderr output message
-        sage_server.MAX_MD_SIZE       # max length of each md (markdown) output message
-        sage_server.MAX_HTML_SIZE     # max length of each html output message
-        sage_server.MAX_TEX_SIZE      # max length of tex output message
-        sage_server.MAX_OUTPUT_MESSAGES   # max number of messages output for a cell.
+class CheckpointFull(Exception):
+    pass
+
+class _CheckpointWriter(object):
     """
-    Namespace = Namespace
-    _prefix       = ''
-    _postfix      = ''
-    _default_mode = 'sage'
+    A file for cPickle that compresses what is written to it into f, and
+    raises CheckpointFull once that is more than limit bytes.
+    """
+    def __init__(self, f, limit):
+        self._f = f
+        self._limit = limit
+        self._z = zlib.compressobj(COMPRESS_LEVEL)
+        self.size = 0
 
-    def _flush_stdio(self):
-        """
-        Flush the standard output streams.  This should be called before sending any message
-        that produces output.
+    def _write(self, s):
+        self.size += len(s)
+        if self.size > self._limit:
+            raise CheckpointFull
+        self._f.write(s)
+
+    def write(self, s):
+        self._write(self._z.compress(s))
+
+    def close(self):
+        self._write(self._z.flush())
+
+def checkpoint_namespace(path, max_size=None, namespace=namespace):
+    """
+    Save the variables in namespace that can be pickled to the file path,
+    using at most max_size bytes (default: CHECKPOINT_MAX_SIZE), so that
+    restore_namespace can bring them back in another session.
+
+    Only variables the user set are saved: not the ones that are still
+    as sage_salvus.default_namespace has them (e.g., everything from
+    sage.all), or whose names start with an underscore.  Modules are
+    saved by name, and imported again when restored.  Each variable is
+    pickled separately, so objects shared by several variables are
+    copies once restored.
+
+    Returns a dict with the list of names saved, a dict mapping each
+    name that was skipped to the reason, and the size of the file.
+    """
+    import sage_server
+    if max_size is None:
+        max_size = sage_server.CHECKPOINT_MAX_SIZE
+    default = getattr(sage_salvus, 'default_namespace', None) or {}
+    namespace.load_lazy()   # so variables restored from a checkpoint, but not used yet, are kept
+    names = {}
+    skipped = {}
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        for name in sorted(namespace.keys()):
+            value = dict.get(namespace, name)
+            if name.startswith('_') or name in CHECKPOINT_EXCLUDE or (name in default and default[name] is value):
+                continue
+            if isinstance(value, types.ModuleType):
+                names[name] = {'module':value.__name__}
+                continue
+            start = f.tell()
+            w = _CheckpointWriter(f, max_size - start)
+            try:
+                cPickle.Pickler(w, cPickle.HIGHEST_PROTOCOL).dump(value)
+                w.close()
+                names[name] = {'offset':start, 'size':w.size}
+                continue
+            except CheckpointFull:
+                skipped[name] = "does not fit in the %s bytes allowed"%max_size
+            except Exception, err:
+                skipped[name] = truncate_text("%s: %s"%(type(err).__name__, err), 256)
+            f.seek(start)
+            f.truncate()
+        offset = f.tell()
+        f.write(json.dumps({'version':1, 'names':names}, separators=JSON_SEPARATORS))
+        f.write(struct.pack(">Q", offset))
+        size = f.tell()
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    log("checkpointed %s variables to '%s' (%s bytes); skipped %s"%(len(names), path, size, skipped.keys()))
+    return {'saved':sorted(names.keys()), 'skipped':skipped, 'size':size}
+
+class CheckpointReader(object):
+    """
+    Read the variables from a checkpoint written by checkpoint_namespace.
+    The file stays open, so replacing it by a newer checkpoint doesn't
+    affect variables that are yet to be loaded.
+    """
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        self._f.seek(-8, 2)
+        end = self._f.tell()
+        offset = struct.unpack(">Q", self._f.read(8))[0]
+        self._f.seek(offset)
+        index = json.loads(self._f.read(end - offset))
+        if index.get('version') != 1:
+            raise ValueError("unknown checkpoint version %s"%index.get('version'))
+        self.names = index['names']
+
+    def load(self, name):
+        e = self.names[name]
+        if 'module' in e:
+            __import__(e['module'])
+            return sys.modules[e['module']]
+        self._f.seek(e['offset'])
+        return cPickle.loads(zlib.decompress(self._f.read(e['size'])))
+
+def restore_namespace(path, namespace=namespace):
+    """
+    Restore the variables saved by checkpoint_namespace to path into
+    namespace.  Each variable is only read (unpickled) once code that
+    uses it runs; see Namespace.lazy.  Returns the list of names.
+    """
+    reader = CheckpointReader(path)
+    for name in reader.names:
+        namespace.lazy(str(name), lambda name=name: reader.load(name))
+    log("restoring %s variables from '%s'"%(len(reader.names), path))
+    return sorted(str(name) for name in reader.names)
+
+def project_path(path):
+    """
+    Return path relative to the home directory of the project.
+    """
+    return os.path.join(os.environ['HOME'], os.path.expanduser(path))
+
+class Salvus(object):
+    """
+    Cell execution state object and wrapper for access to special SageMathCloud functionality.
+
+    An instance of this object is created each time you execute a cell.  It has various methods
+    for sending different types of output messages, links to files, etc.
+
+    OUTPUT LIMITATIONS -- There is an absolute limit on the number of messages output for a given
+    cell, and also the size of the output message for each cell.  You can access or change
+    those limits dynamically in a worksheet as follows by viewing or changing any of the
+    following variables::
+
+        import sage_server
+        sage_server.MAX_STDOUT_SIZE   # max length of each stdout output message
+        sage_server.MAX_STDERR_SIZE   # max length of each stderr output message
+        sage_server.MAX_MD_SIZE       # max length of each md (markdown) output message
+        sage_server.MAX_HTML_SIZE     # max length of each html output message
+        sage_server.MAX_TEX_SIZE      # max length of tex output message
+        sage_server.MAX_OUTPUT_MESSAGES   # max number of messages output in a burst
+        sage_server.OUTPUT_MESSAGES_PER_SECOND   # sustained output messages per second
+
+    Output beyond those rates is coalesced or dropped, and the number of dropped
+    messages and characters is reported at the end of the cell.  See the top of
+    sage_server.py for the other OUTPUT limits, and sage_server.output_throttle.stats().
+    """
+    Namespace = Namespace
+    _prefix       = ''
+    _postfix      = ''
+    _default_mode = 'sage'
+
+    def _flush_stdio(self):
+        """
+        Flush the standard output streams.  This should be called before sending any message
+        that produces output.
         """
         sys.stdout.flush()
         sys.stderr.flush()
@@ -476,7 +1637,6 @@ class Salvus(object):
 
     def __init__(self, conn, id, data=None, cell_id=None, message_queue=None):
         self._conn = conn
-        self._num_output_messages = 0
         self._id   = id
         self._done = True    # done=self._done when last execute message is sent; e.g., set self._done = False to not close cell on code term.
         self.data = data
@@ -484,6 +1644,10 @@ class Salvus(object):
         self.namespace = namespace
         self.message_queue = message_queue
         self.code_decorators = [] # gets reset if there are code decorators
+        self._pending_blobs = []  # sha1's of blobs sent by this cell whose save_blob ack we haven't seen
+        self._spill = None        # OutputSpill with output too large to send, if any
+        self._spill_lock = threading.Lock()   # output is also sent from the OutputFlusher thread
+        self._stats = None        # resources used by the cell, sent with the done message
         # Alias: someday remove all references to "salvus" and instead use smc.
         # For now this alias is easier to think of and use.
         namespace['smc'] = namespace['salvus'] = self   # beware of circular ref?
@@ -493,19 +1657,77 @@ class Salvus(object):
         import sage.all
         sage.all.salvus = self
 
+    def _spill_oversize(self, kwds):
+        """
+        Replace any text output in kwds that is too large for an output
+        message by a preview, and write it in full to the spill files.
+        """
+        import sage_server
+        for key, kind, limit in (('stdout', 'txt', sage_server.MAX_STDOUT_SIZE),
+                                 ('stderr', 'txt', sage_server.MAX_STDERR_SIZE),
+                                 ('html',   'html', sage_server.MAX_HTML_SIZE),
+                                 ('md',     'md',   sage_server.MAX_MD_SIZE)):
+            v = kwds.get(key)
+            if v is not None and len(v) > limit:
+                self._spill_write(kind, v)
+                n = min(limit, sage_server.MAX_SPILL_PREVIEW_SIZE)
+                kwds[key] = v[:n] + u"\n[... %s more characters in output.%s]\n"%(len(v) - n, kind)
+
+    def _spill_write(self, kind, text):
+        with self._spill_lock:
+            if self._spill is None:
+                import sage_server
+                self._spill = OutputSpill(sage_server.MAX_SPILL_SIZE)
+            self._spill.write(kind, text)
+
+    def _send_spill(self):
+        """
+        Send the spill files of this cell, if any, as blobs, with output
+        messages linking to them.
+        """
+        with self._spill_lock:
+            spill, self._spill = self._spill, None
+        if spill is None:
+            return
+        import sage_server
+        try:
+            for path in spill.files():
+                file_uuid = self._conn.send_file(path)
+                self._pending_blobs.append(file_uuid)
+                mesg = message.output(id=self._id, file={'filename':os.path.basename(path),
+                                                         'uuid':file_uuid, 'show':True})
+                # like a done message, this is never dropped by the throttle
+                sage_server.output_throttle.consume(output_size(mesg))
+                self._conn.send_json(mesg)
+        finally:
+            spill.remove()
+
     def _send_output(self, *args, **kwds):
+        self._spill_oversize(kwds)
         mesg = message.output(*args, **kwds)
-        if not mesg.get('once',False):
-            self._num_output_messages += 1
         import sage_server
-        if self._num_output_messages > sage_server.MAX_OUTPUT_MESSAGES:
-            if self._num_output_messages == sage_server.MAX_OUTPUT_MESSAGES+1:
-                err = "\nToo many output messages (at most %s per cell): attempting to terminate..."%sage_server.MAX_OUTPUT_MESSAGES
-                self._conn.send_json(message.output(stderr=err, id=self._id, once=False))
-            if mesg.get('done',False):
-                self._conn.send_json(message.output(done=True, id=self._id))
-            raise KeyboardInterrupt
+        throttle = sage_server.output_throttle
+        size = output_size(mesg)
+        if mesg.get('done',False) or mesg.get('once',False):
+            # never dropped, but still counted against the rate
+            throttle.consume(size)
+        elif not throttle.take(size):
+            throttle.drop(size)
+            return
+        self._conn.send_json(mesg)
 
+    def _send_buffered_output(self, stdout, stderr, done):
+        """
+        Send stdout and stderr coalesced by an OutputBuffer, which already
+        waited for the output throttle.
+        """
+        kwds = {'stdout':stdout, 'stderr':stderr}
+        self._spill_oversize(kwds)
+        if done:
+            kwds['stats'] = self._stats
+        mesg = message.output(id=self._id, done=done, **kwds)
+        import sage_server
+        sage_server.output_throttle.consume(output_size(mesg))
         self._conn.send_json(mesg)
 
     def obj(self, obj, done=False):
@@ -691,7 +1913,9 @@ class Salvus(object):
     def file(self, filename, show=True, done=False, download=False, once=False, events=None, raw=False):
         """
         Display or provide a link to the given file.  Raises a RuntimeError if this
-        is not possible, e.g, if the file is too large.
+        is not possible, e.g, if the file is too large.  (If show=True, the
+        file is saved while the cell keeps running, and any such error is instead
+        written to stderr when the cell finishes.)
 
         If show=True (the default), the browser will show the file,
         or provide a clickable link to it if there is no way to show it.
@@ -726,7 +1950,8 @@ class Salvus(object):
 
         The uuid is based on the Sha-1 hash of the file content (it is computed using the
         function sage_server.uuidsha1).  Any two files with the same content have the
-        same Sha1 hash.
+        same Sha1 hash.  Content that was already saved during this session is not
+        sent again; sage_server.blob_cache.stats() shows how often that happens.
         """
         filename = unicode8(filename)
         if raw:
@@ -745,28 +1970,50 @@ class Salvus(object):
             else:
                 return TemporaryURL(url=url, ttl=0)
 
-        file_uuid = self._conn.send_file(filename)
-
-        mesg = None
-        while mesg is None:
-            self.message_queue.recv()
-            for i, (typ, m) in enumerate(self.message_queue.queue):
-                if typ == 'json' and m.get('event') == 'save_blob' and m.get('sha1') == file_uuid:
-                    mesg = m
-                    del self.message_queue[i]
-                    break
-
-        if 'error' in mesg:
-            raise RuntimeError("error saving blob -- %s"%mesg['error'])
-
-        self._flush_stdio()
-        self._send_output(id=self._id, once=once, file={'filename':filename, 'uuid':file_uuid, 'show':show}, events=events, done=done)
-        if not show:
+        import sage_server  # so sage_server.blob_cache in a worksheet is the cache used here
+        blob_cache = sage_server.blob_cache
+        file_uuid = blob_cache.file_uuid(filename)
+        ttl = blob_cache.lookup(file_uuid)
+        if ttl is None:
+            self._conn.send_file(filename, sha1=file_uuid)
+
+        if show:
+            # The hub receives the blob before this output message, so we only
+            # have to know that it was saved by the time the cell is done.
+            if ttl is None:
+                self._pending_blobs.append(file_uuid)
+            self._flush_stdio()
+            self._send_output(id=self._id, once=once, file={'filename':filename, 'uuid':file_uuid, 'show':show}, events=events, done=done)
+        else:
+            # The caller wants a url and its ttl right now.
+            if ttl is None:
+                mesg = self.message_queue.wait_for_save_blob([file_uuid])[file_uuid]
+                if 'error' in mesg:
+                    raise RuntimeError("error saving blob -- %s"%mesg['error'])
+                blob_cache.acknowledged(mesg)
+                ttl = mesg.get('ttl',0)
+            self._flush_stdio()
+            self._send_output(id=self._id, once=once, file={'filename':filename, 'uuid':file_uuid, 'show':show}, events=events, done=done)
             info = self.project_info()
             url = u"%s/blobs/%s?uuid=%s"%(info['base_url'], filename, file_uuid)
             if download:
                 url += u'?download'
-            return TemporaryURL(url=url, ttl=mesg.get('ttl',0))
+            return TemporaryURL(url=url, ttl=ttl)
+
+    def _wait_for_blobs(self):
+        """
+        Wait for the hub to acknowledge all blobs shown by this cell, and
+        write an error to stderr for each one that it failed to save.
+        """
+        if not self._pending_blobs:
+            return
+        sha1s, self._pending_blobs = self._pending_blobs, []
+        import sage_server
+        for sha1, mesg in self.message_queue.wait_for_save_blob(sha1s).iteritems():
+            if 'error' in mesg:
+                sys.stderr.write("error saving blob %s -- %s\n"%(sha1, mesg['error']))
+            else:
+                sage_server.blob_cache.acknowledged(mesg)
 
     def default_mode(self, mode=None):
         """
@@ -860,10 +2107,12 @@ class Salvus(object):
 
         for start, stop, block in blocks:
             if preparse:
-                block = sage_parsing.preparse_code(block)
+                block = code_cache.preparse(block)
             sys.stdout.reset(); sys.stderr.reset()
             try:
                 b = block.rstrip()
+                if b.endswith('?'):
+                    load_lazy_names(b, namespace)
                 if b.endswith('??'):
                     p = sage_parsing.introspect(block,
                                    namespace=namespace, preparse=False)
@@ -872,13 +2121,27 @@ class Salvus(object):
                     p = sage_parsing.introspect(block, namespace=namespace, preparse=False)
                     self.code(source = p['result'], mode = "text/x-rst")
                 else:
-                    exec compile(block+'\n', '', 'single') in namespace, locals
+                    code_object = code_cache.compile(block)
+                    if isinstance(namespace, Namespace):
+                        namespace.load_lazy(code_object)
+                    try:
+                        exec code_object in namespace, locals
+                    finally:
+                        if isinstance(namespace, Namespace):
+                            namespace.notify()
+                        sage_parsing.namespace_changed()
+                        if memory_watchdog is not None:
+                            memory_watchdog.after_block()
                 sys.stdout.flush()
                 sys.stderr.flush()
             except:
                 sys.stdout.flush()
                 sys.stderr.write('Error in lines %s-%s\n'%(start+1, stop+1))
                 traceback.print_exc()
+                if memory_watchdog is not None:
+                    m = memory_watchdog.interrupt_message()
+                    if m:
+                        sys.stderr.write(m)
                 sys.stderr.flush()
                 break
 
@@ -891,10 +2154,8 @@ class Salvus(object):
         if isinstance(code_decorators, (str, unicode)):
             code_decorators = [code_decorators]
 
-        if preparse:
-            code_decorators = map(sage_parsing.preparse_code, code_decorators)
-
-        code_decorators = [eval(code_decorator, self.namespace) for code_decorator in code_decorators]
+        code_decorators = [eval(code_decorator, self.namespace)
+                           for code_decorator in code_cache.decorators(code_decorators, preparse)]
 
         # The code itself may want to know exactly what code decorators are in effect.
         # For example, r.eval can do extra things when being used as a decorator.
@@ -972,6 +2233,30 @@ class Salvus(object):
         """
         self._send_output(clear=True, id=self._id, done=done)
 
+    def checkpoint(self, path, max_size=None):
+        """
+        Save the variables of this session that can be pickled to the file
+        path (relative to the home directory), using at most max_size bytes;
+        prints the variables that were skipped and why.
+
+        A later session restores them with salvus.restore_checkpoint(path).
+        See sage_server.checkpoint_namespace.
+        """
+        import sage_server
+        result = sage_server.checkpoint_namespace(sage_server.project_path(path), max_size=max_size,
+                                                  namespace=self.namespace)
+        for name in sorted(result['skipped']):
+            print "skipped %s: %s"%(name, result['skipped'][name])
+        print "saved %s variables (%s bytes)"%(len(result['saved']), result['size'])
+
+    def restore_checkpoint(self, path):
+        """
+        Restore the variables saved by salvus.checkpoint(path).  Each one is
+        only loaded when code that uses it runs.  Returns the list of names.
+        """
+        import sage_server
+        return sage_server.restore_namespace(sage_server.project_path(path), namespace=self.namespace)
+
     def stdout(self, output, done=False, once=None):
         """
         Send the string output (or unicode8(output) if output is not a
@@ -1249,7 +2534,14 @@ class Salvus(object):
 
 Salvus.pdf.__func__.__doc__ = sage_salvus.show_pdf.__doc__
 
-def execute(conn, id, code, data, cell_id, preparse, message_queue):
+def execute(conn, id, code, data, cell_id, preparse, message_queue, usage=None):
+    """
+    Execute code for the execute_code message with the given id.  If
+    usage (a ResourceUsage) is given, the resources used are measured
+    and sent as stats in the done message.
+    """
+    if usage is not None:
+        start = usage.start()
 
     salvus = Salvus(conn=conn, id=id, data=data, message_queue=message_queue, cell_id=cell_id)
     salvus.start_executing()
@@ -1257,8 +2549,12 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
     try:
         # initialize the salvus output streams
         streams = (sys.stdout, sys.stderr)
-        sys.stdout = BufferedOutputStream(salvus.stdout)
-        sys.stderr = BufferedOutputStream(salvus.stderr)
+        import sage_server
+        output = OutputBuffer(salvus._send_buffered_output, throttle=sage_server.output_throttle,
+                              max_pending=sage_server.MAX_PENDING_OUTPUT_SIZE, spill=salvus._spill_write,
+                              spill_preview=sage_server.MAX_SPILL_PREVIEW_SIZE)
+        sys.stdout = BufferedOutputStream(output)
+        sys.stderr = BufferedOutputStream(output, is_stderr=True)
         try:
             # initialize more salvus functionality
             sage_salvus.salvus = salvus
@@ -1276,13 +2572,24 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         salvus.execute(code, namespace=namespace, preparse=preparse)
 
     finally:
+        try:
+            # send any previews of spilled output before the links to it
+            output.flush(force=True)
+            salvus._send_spill()
+        except Exception, err:
+            log.error("error sending spilled output -- %s"%err)
+        try:
+            salvus._wait_for_blobs()
+        except Exception, err:
+            log.error("error waiting for blobs to be saved -- %s"%err)
+        summary = sage_server.output_throttle.cell_summary()
+        if summary:
+            output.write(True, summary, force=True)
+        if usage is not None:
+            salvus._stats = usage.stop(start)
+            log("cell %s used %s"%(id, salvus._stats))
         # there must be exactly one done message, unless salvus._done is False.
-        if sys.stderr._buf:
-            if sys.stdout._buf:
-                sys.stdout.flush()
-            sys.stderr.flush(done=salvus._done)
-        else:
-            sys.stdout.flush(done=salvus._done)
+        output.flush(done=salvus._done, force=True)
         (sys.stdout, sys.stderr) = streams
 
 
@@ -1310,6 +2617,285 @@ def drop_privileges(id, home, transient, username):
     sage.misc.misc.DOT_SAGE = home + '/.sage/'
 
 
+class ResourceUsage(object):
+    """
+    Measure the resources used by each cell of a session: wall and CPU
+    time, how much it raised the peak resident set size, and the output
+    messages, bytes and blobs sent on the connection conn while it ran.
+    The totals over all cells are kept for the session_stats message.
+
+    EXAMPLES::
+
+        usage = ResourceUsage(conn)
+        start = usage.start()
+        ...  # run the cell
+        stats = usage.stop(start)   # included in the cell's done message
+    """
+    KEYS = ('wall', 'user', 'sys', 'maxrss_delta', 'messages', 'bytes', 'blobs')
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.cells = 0
+        self.totals = dict.fromkeys(self.KEYS, 0)
+
+    def _measure(self):
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        c = self._conn
+        return {'wall':time.time(), 'user':r.ru_utime, 'sys':r.ru_stime, 'maxrss_delta':r.ru_maxrss,
+                'messages':c.frames_sent - c.blobs_sent, 'bytes':c.bytes_sent, 'blobs':c.blobs_sent}
+
+    def _rounded(self, stats):
+        for k in ('wall', 'user', 'sys'):
+            stats[k] = round(stats[k], 3)
+        return stats
+
+    def start(self):
+        """
+        Return the measurements to pass to stop when the cell is done.
+        """
+        return self._measure()
+
+    def stop(self, start):
+        """
+        Return the resources used since start, and add them to the totals.
+        Times are in seconds and maxrss_delta is in kilobytes.
+        """
+        end = self._measure()
+        stats = dict((k, end[k] - start[k]) for k in self.KEYS)
+        self.cells += 1
+        for k in self.KEYS:
+            self.totals[k] += stats[k]
+        return self._rounded(stats)
+
+    def summary(self):
+        """
+        Return the totals over all cells so far, with the number of cells
+        and the peak resident set size (in kilobytes) of the session.
+        """
+        stats = self._rounded(dict(self.totals))
+        stats['cells'] = self.cells
+        stats['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return stats
+
+# Sessions of a project may be limited in how much memory they use, by
+# setting session_memory in its info.json (see Salvus.project_info) to,
+# e.g., {"soft":2000, "hard":3000, "address_space":8000} (all in MB):
+#
+#   - soft -- resident set size at which the session collects garbage,
+#     closes all pylab figures, and warns in the running cell
+#   - hard -- resident set size at which the running cell is interrupted
+#   - address_space -- RLIMIT_AS of the session, so allocating beyond it
+#     raises MemoryError
+#
+# Any of them may be left out.  The resident set size is checked every
+# MEMORY_CHECK_INTERVAL seconds.
+MEMORY_CHECK_INTERVAL = 1
+
+def session_memory_limits():
+    """
+    Return the dict of memory limits (in bytes) of sessions of this
+    project, with keys soft, hard and address_space (None if not set).
+    """
+    conf = INFO.get('session_memory')
+    if not isinstance(conf, dict):
+        conf = {}
+    limits = {}
+    for key in ('soft', 'hard', 'address_space'):
+        try:
+            limits[key] = int(float(conf[key])*2**20) if conf.get(key) else None
+        except (TypeError, ValueError):
+            log.warning("invalid session_memory %s in info.json: %r"%(key, conf[key]))
+            limits[key] = None
+    return limits
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes, or None if
+    it can't be determined (no /proc).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+class MemoryWatchdog(object):
+    """
+    A daemon thread that watches the resident set size of a session and
+    handles crossing the soft and hard limits (in bytes; see
+    session_memory_limits).
+
+    At the soft limit it runs the garbage collector, warns in the running
+    cell, and asks for all pylab figures to be closed after the current
+    block (see after_block), once until the memory drops below it again.
+    At the hard limit, if collecting garbage doesn't help, it interrupts
+    the running cell (SIGINT, like the interrupt button), once per cell;
+    Salvus.execute then explains why (see interrupt_message).
+
+    The session sets cell_id to the id of the running cell, if any.
+    """
+    def __init__(self, conn, soft=None, hard=None, interval=MEMORY_CHECK_INTERVAL):
+        self._conn = conn
+        self.soft = soft
+        self.hard = hard
+        self.cell_id = None
+        self._warned = False
+        self._close_figures = False
+        self._interrupted_cell = None
+        self._interrupt_message = None
+        if (soft or hard) and current_rss() is not None:
+            t = threading.Thread(target=self._run, name='memory watchdog')
+            t.daemon = True
+            t.start()
+
+    def _run(self):
+        while True:
+            time.sleep(MEMORY_CHECK_INTERVAL)
+            try:
+                self.check()
+            except Exception, err:
+                log.error("memory watchdog -- %s"%err)
+
+    def _collect(self):
+        gc.collect()
+        self._close_figures = True
+        return current_rss()
+
+    def check(self):
+        rss = current_rss()
+        if self.soft and rss > self.soft and not self._warned:
+            self._warned = True
+            rss = self._collect()
+            log.warning("session using %s MB, over its soft limit of %s MB"%(rss >> 20, self.soft >> 20))
+            cell_id = self.cell_id
+            if cell_id is not None:
+                s = "\nWarning: this session is using %s MB of memory, more than its soft limit of %s MB, so it collected garbage and will close all pylab figures."%(rss >> 20, self.soft >> 20)
+                if self.hard:
+                    s += "  At %s MB the running computation is interrupted."%(self.hard >> 20)
+                mesg = message.output(id=cell_id, stderr=s + "\n")
+                import sage_server  # the throttle the session's output is counted against
+                sage_server.output_throttle.consume(output_size(mesg))
+                self._conn.send_json(mesg)
+        elif self.soft and rss < self.soft:
+            self._warned = False
+        if self.hard and rss > self.hard:
+            cell_id = self.cell_id
+            if cell_id is None or cell_id == self._interrupted_cell:
+                return
+            rss = self._collect()
+            if rss > self.hard:
+                log.warning("session using %s MB, over its hard limit of %s MB -- interrupting cell %s"%(rss >> 20, self.hard >> 20, cell_id))
+                self._interrupted_cell = cell_id
+                self._interrupt_message = ("MemoryError: this session was using %s MB of memory, more than its limit of %s MB, so the computation was interrupted.  Delete large variables (or restart the worksheet) to free memory.\n"%(rss >> 20, self.hard >> 20))
+                os.kill(os.getpid(), signal.SIGINT)
+
+    def interrupt_message(self):
+        """
+        Return (once) the explanation for the last interrupt done by the
+        watchdog, or None.
+        """
+        m, self._interrupt_message = self._interrupt_message, None
+        return m
+
+    def after_block(self):
+        """
+        Called by Salvus.execute after each block, in the main thread, to
+        close pylab figures if the soft limit was crossed.
+        """
+        if self._close_figures:
+            self._close_figures = False
+            if pylab is not None:
+                try:
+                    pylab.close('all')
+                except Exception, err:
+                    log.error("unable to close pylab figures -- %s"%err)
+
+# The MemoryWatchdog of the session run by this process, if any.
+memory_watchdog = None
+
+# Seconds allowed for answering an introspect message from a snapshot of
+# the session (see introspect_snapshot) before the snapshot is killed.
+INTROSPECT_TIMEOUT = 10
+
+# Whether introspection may evaluate code (for at most a second) to find the
+# object it is about, when looking it up by names, attributes and constant
+# subscripts isn't enough (see sage_parsing.introspect); an introspect
+# message can also ask for it with evaluate:true.
+INTROSPECT_EVALUATE = False
+
+class SessionReader(object):
+    """
+    Receive the messages of a session in a background thread, so that
+    introspect messages can be answered while a cell is executing.
+
+    While executing is true, introspect messages are answered from a
+    forked snapshot of the session (see introspect_snapshot), which
+    sees the namespace as it was at that moment and can neither affect
+    nor be affected by the running code.  session_stats messages are
+    always answered right away from usage (a ResourceUsage).  All other
+    messages are returned in order by recv, which works like
+    ConnectionJSON.recv.
+
+    The thread only gets to run when the interpreter switches to it, so
+    code that holds the GIL for a long time (e.g., a long computation
+    in C) still delays completions until it lets go.
+    """
+    def __init__(self, conn, usage):
+        self.conn = conn
+        self.usage = usage
+        self.executing = False
+        self._messages = collections.deque()
+        self._error = None
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL, os.O_NONBLOCK)
+        # A signal also wakes up recv, so that its handler runs (e.g., raising
+        # KeyboardInterrupt while waiting for a save_blob message).
+        signal.set_wakeup_fd(self._wakeup_w)
+        t = threading.Thread(target=self._run, name='session reader')
+        t.daemon = True
+        t.start()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError, err:
+            if err.errno != errno.EAGAIN:  # pipe is full, so recv will wake up anyway
+                raise
+
+    def _run(self):
+        while True:
+            try:
+                typ, mesg = self.conn.recv()
+            except Exception, err:
+                self._error = err
+                self._wakeup()
+                return
+            if self.executing and typ == 'json' and mesg.get('event') == 'introspect':
+                try:
+                    introspect_snapshot(self.conn, mesg)
+                except Exception, err:
+                    log.error("error introspecting a snapshot of the session -- %s"%err)
+                continue
+            if typ == 'json' and mesg.get('event') == 'session_stats':
+                stats = self.usage.summary()
+                stats['code_cache'] = code_cache.stats()
+                self.conn.send_json(message.session_stats(id=mesg.get('id'), stats=stats))
+                continue
+            self._messages.append((typ, mesg))
+            self._wakeup()
+
+    def recv(self):
+        while True:
+            if self._messages:
+                return self._messages.popleft()
+            if self._error is not None:
+                raise self._error
+            try:
+                os.read(self._wakeup_r, 4096)
+            except OSError, err:
+                if err.errno != errno.EINTR:
+                    raise
+
 class MessageQueue(list):
     def __init__(self, conn):
         self.queue = []
@@ -1344,7 +2930,50 @@ class MessageQueue(list):
         self.queue.insert(0,mesg)
         return mesg
 
+    def wait_for_save_blob(self, sha1s):
+        """
+        Wait until a save_blob message has arrived for each of the given
+        sha1's (one per occurrence, since each send gets its own ack),
+        remove those messages from the queue, and return a dict mapping
+        each sha1 to its message (an error message, if any of its acks was
+        an error).  Other messages stay queued.
+        """
+        pending = {}
+        for sha1 in sha1s:
+            pending[sha1] = pending.get(sha1, 0) + 1
+        result = {}
+        def take(i):
+            typ, m = self.queue[i]
+            if typ == 'json' and m.get('event') == 'save_blob' and m.get('sha1') in pending:
+                sha1 = m['sha1']
+                pending[sha1] -= 1
+                if not pending[sha1]:
+                    del pending[sha1]
+                if sha1 not in result or 'error' in m:
+                    result[sha1] = m
+                del self.queue[i]
+        for i in reversed(range(len(self.queue))):
+            take(i)
+        while pending:
+            self.recv()
+            take(0)
+        return result
+
+
+
+def prepare_session():
+    """
+    Per-process initialization of a freshly forked child, which must
+    happen before it runs any code for a session.  Warm children in
+    the SessionPool do this before they even accept a connection.
+    """
+    # seed the random number generator(s)
+    import sage.all; sage.all.set_random_seed()
+    import random; random.seed(sage.all.initial_seed())
 
+    # get_memory_usage is (by ignorant design) not aware of being forked... (should post a trac ticket!)
+    import sage.misc.getusage
+    sage.misc.getusage._proc_status = "/proc/%s/status"%os.getpid()
 
 def session(conn):
     """
@@ -1356,29 +2985,39 @@ def session(conn):
 
     - ``conn`` -- the TCP connection
     """
-    mq = MessageQueue(conn)
+    global memory_watchdog, gc_collect_time
+    limits = session_memory_limits()
+    if limits['address_space']:
+        try:
+            hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+            if hard != resource.RLIM_INFINITY:
+                limits['address_space'] = min(limits['address_space'], hard)
+            resource.setrlimit(resource.RLIMIT_AS, (limits['address_space'], hard))
+        except (ValueError, resource.error), err:
+            log.error("unable to limit the address space to %s bytes -- %s"%(limits['address_space'], err))
+    memory_watchdog = MemoryWatchdog(conn, soft=limits['soft'], hard=limits['hard'])
+    gc_collect_time = time.time()   # see collect_frozen_gc
+
+    usage = ResourceUsage(conn)
+    reader = SessionReader(conn, usage)
+    mq = MessageQueue(reader)
 
     pid = os.getpid()
 
-    # seed the random number generator(s)
-    import sage.all; sage.all.set_random_seed()
-    import random; random.seed(sage.all.initial_seed())
-
-    # get_memory_usage is (by ignorant design) not aware of being forked... (should post a trac ticket!)
-    import sage.misc.getusage
-    sage.misc.getusage._proc_status = "/proc/%s/status"%os.getpid()
-
     cnt = 0
     while True:
         try:
             typ, mesg = mq.next_mesg()
 
             #print 'INFO:child%s: received message "%s"'%(pid, mesg)
-            log("handling message ", truncate_text(unicode8(mesg), 256))
+            if log.enabled(logging.DEBUG):
+                log.debug("handling message ", truncate_text(unicode8(mesg), 256))
             event = mesg['event']
             if event == 'terminate_session':
                 return
             elif event == 'execute_code':
+                reader.executing = True
+                memory_watchdog.cell_id = mesg['id']
                 try:
                     execute(conn          = conn,
                             id            = mesg['id'],
@@ -1386,14 +3025,23 @@ def session(conn):
                             data          = mesg.get('data',None),
                             cell_id       = mesg.get('cell_id',None),
                             preparse      = mesg['preparse'],
-                            message_queue = mq)
+                            message_queue = mq,
+                            usage         = usage)
                 except Exception, err:
-                    log("ERROR -- exception raised '%s' when executing '%s'"%(err, mesg['code']))
+                    log.error("ERROR -- exception raised '%s' when executing '%s'"%(err, mesg['code']))
+                finally:
+                    reader.executing = False
+                    memory_watchdog.cell_id = None
+                    memory_watchdog.interrupt_message()  # in case the cell didn't report it
+                    collect_frozen_gc()
             elif event == 'introspect':
                 try:
-                    introspect(conn=conn, id=mesg['id'], line=mesg['line'], preparse=mesg['preparse'])
+                    introspect(conn=conn, id=mesg['id'], line=mesg['line'], preparse=mesg['preparse'],
+                               evaluate=mesg.get('evaluate'))
                 except:
                     pass
+            elif event == 'checkpoint_namespace':
+                checkpoint(conn=conn, id=mesg.get('id'), path=mesg['path'], max_size=mesg.get('max_size'))
             else:
                 raise RuntimeError("invalid message '%s'"%mesg)
         except:
@@ -1409,65 +3057,205 @@ def session(conn):
                 pass
 
 
-def introspect(conn, id, line, preparse):
+def checkpoint(conn, id, path, max_size=None):
+    try:
+        result = checkpoint_namespace(project_path(path), max_size=max_size)
+    except Exception, err:
+        log.error("unable to checkpoint to '%s' -- %s"%(path, err))
+        result = {'error':str(err)}
+    conn.send_json(message.checkpoint_namespace(id=id, path=path, max_size=max_size, **result))
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+def load_lazy_names(line, namespace):
+    """
+    Bind the lazy names of namespace (see Namespace.lazy) that the line
+    refers to, so introspecting it finds what they are bound to.
+    """
+    if isinstance(namespace, Namespace) and namespace.lazy_names():
+        namespace.load_lazy(names=_IDENTIFIER.findall(line))
+
+def introspect_message(conn, id, line, preparse, evaluate=None):
+    """
+    Return the reply to an introspect message.
+    """
     salvus = Salvus(conn=conn, id=id) # so salvus.[tab] works -- note that Salvus(...) modifies namespace.
-    z = sage_parsing.introspect(line, namespace=namespace, preparse=preparse)
+    load_lazy_names(line, namespace)
+    if evaluate is None:
+        import sage_server  # so that the user can set INTROSPECT_EVALUATE
+        evaluate = sage_server.INTROSPECT_EVALUATE
+    z = sage_parsing.introspect(line, namespace=namespace, preparse=preparse, evaluate=evaluate)
     if z['get_completions']:
         mesg = message.introspect_completions(id=id, completions=z['result'], target=z['target'])
     elif z['get_help']:
         mesg = message.introspect_docstring(id=id, docstring=z['result'], target=z['expr'])
     elif z['get_source']:
         mesg = message.introspect_source_code(id=id, source_code=z['result'], target=z['expr'])
-    conn.send_json(mesg)
+    return mesg
+
+def introspect(conn, id, line, preparse, evaluate=None):
+    conn.send_json(introspect_message(conn, id, line, preparse, evaluate))
 
-def handle_session_term(signum, frame):
+def _read_all(fd, timeout):
+    """
+    Read fd until end of file and return what was read, or None if that
+    takes more than timeout seconds.
+    """
+    chunks = []
+    deadline = time.time() + timeout
     while True:
+        wait = deadline - time.time()
+        if wait <= 0:
+            return None
         try:
-            pid, exit_status = os.waitpid(-1, os.WNOHANG)
-        except:
-            return
-        if not pid: return
+            if not select.select([fd], [], [], wait)[0]:
+                continue
+            s = os.read(fd, 65536)
+        except (OSError, select.error), err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        if not s:
+            return ''.join(chunks)
+        chunks.append(s)
+
+def empty_introspect_message(id, line):
+    """
+    Return a reply to an introspect message that finds nothing.
+    """
+    line = line.rstrip()
+    if line.endswith('??'):
+        return message.introspect_source_code(id=id, source_code='', target='')
+    elif line.endswith('?'):
+        return message.introspect_docstring(id=id, docstring='', target='')
+    return message.introspect_completions(id=id, completions=[], target='')
+
+def introspect_snapshot(conn, mesg):
+    """
+    Answer the introspect message mesg from a forked copy of this
+    process.  The fork happens while holding the GIL, so the copy sees
+    a consistent namespace, and whatever introspection runs (e.g., a
+    property evaluated for completions) does not touch the session.
+
+    The copy is killed if it doesn't answer within INTROSPECT_TIMEOUT
+    seconds (whatever the session did to SIGALRM), and the reply is then
+    empty.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Only this thread exists in the child, and the others may have held
+        # locks (log, output buffers, conn), so it only writes to the pipe.
+        try:
+            os.close(r)
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+            sage_parsing.namespace_changed()   # by the cell that is running
+            s = json.dumps(introspect_message(conn, mesg['id'], mesg['line'], mesg['preparse'], mesg.get('evaluate')))
+            while s:
+                s = s[os.write(w, s):]
+        finally:
+            os._exit(0)
+    os.close(w)
+    try:
+        s = _read_all(r, INTROSPECT_TIMEOUT)
+        if s is None:
+            log.warning("introspection of '%s' took more than %s seconds; killing it"%(mesg['line'], INTROSPECT_TIMEOUT))
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+    finally:
+        os.close(r)
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass  # e.g., the user's code set SIGCHLD to SIG_IGN
+    if s:
+        conn.send_json(json.loads(s))
+    else:
+        conn.send_json(empty_introspect_message(mesg['id'], mesg['line']))
 
 secret_token = None
 secret_token_path = os.path.join(os.environ['SAGEMATHCLOUD'], 'data/secret_token')
 
-def unlock_conn(conn):
+def read_secret_token():
+    """
+    Return the secret token that clients must send to unlock a
+    connection, or None if it can't be read (yet).
+    """
     global secret_token
     if secret_token is None:
         try:
             secret_token = open(secret_token_path).read()
         except:
-            conn.send('n')
-            conn.send("Unable to accept connection, since Sage server doesn't yet know the secret token; unable to read from '%s'"%secret_token_path)
-            conn.close()
+            return None
+    return secret_token
+
+def refuse_conn(conn, reason):
+    """
+    Tell the client that its connection is not unlocked, and why, and close it.
+    """
+    try:
+        conn.send('n')
+        conn.send(reason)
+    except socket.error:
+        pass
+    conn.close()
+
+def recv_retry(conn, n):
+    """
+    Return conn.recv(n), retrying if it is interrupted by a signal.  In
+    the server a child exiting (SIGCHLD) interrupts the recv of a socket
+    with a timeout, even though the handler is installed to restart
+    system calls.
+    """
+    for i in range(20):
+        try:
+            return conn.recv(n)
+        except socket.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+    raise EOFError
+
+def unlock_conn(conn):
+    if read_secret_token() is None:
+        refuse_conn(conn, "Unable to accept connection, since Sage server doesn't yet know the secret token; unable to read from '%s'"%secret_token_path)
+        return False
 
     n = len(secret_token)
     token = ''
     while len(token) < n:
-        token += conn.recv(n)
+        t = recv_retry(conn, n - len(token))
+        if not t:
+            break # client closed the connection
+        token += t
         if token != secret_token[:len(token)]:
             break # definitely not right -- don't try anymore
     if token != secret_token:
-        conn.send('n')  # no -- invalid login
-        conn.send("Invalid secret token.")
-        conn.close()
+        refuse_conn(conn, "Invalid secret token.")  # no -- invalid login
         return False
     else:
         conn.send('y') # yes -- valid login
         return True
 
-def serve_connection(conn):
-    global PID
-    PID = os.getpid()
+# Control messages are handled by whichever process accepts the connection,
+# without forking a session for them.  This many seconds are allowed for the
+# client to unlock the connection and send its first message.
+CONTROL_TIMEOUT = 10
+
+def recv_first_message(conn):
+    """
+    Unlock conn and receive the first message on it.  Returns the pair
+    (ConnectionJSON, message), or None if the client failed to unlock
+    the connection (it is then closed).
+    """
     # First the client *must* send the secret shared token. If they
     # don't, we return (and the connection will have been destroyed by
     # unlock_conn).
-    log("Serving a connection")
     log("Waiting for client to unlock the connection...")
-    # TODO -- put in a timeout (?)
     if not unlock_conn(conn):
         log("Client failed to unlock connection. Dumping them.")
-        return
+        return None
     log("Connection unlocked.")
 
     try:
@@ -1475,42 +3263,1012 @@ def serve_connection(conn):
         typ, mesg = conn.recv()
         log("Received message %s"%mesg)
     except Exception, err:
-        log("Error receiving message: %s (connection terminated)"%str(err))
+        log.error("Error receiving message: %s (connection terminated)"%str(err))
         raise
+    return conn, mesg
+
+class Handshake(object):
+    """
+    A connection accepted by the server, whose client has yet to unlock
+    it and send its first message.  The server selects on fileno() and
+    calls step whenever the socket is readable, so a slow or silent
+    client doesn't hold up other connections; it drops the connection
+    if it isn't done by the deadline.
+
+    Only the token and the first frame are read, never more, so
+    whatever the client sends after its first message is left for the
+    process that handles the connection.
+    """
+    def __init__(self, conn, addr, accept_time):
+        self.conn = conn
+        self.addr = addr
+        self.accept_time = accept_time
+        self.deadline = accept_time + CONTROL_TIMEOUT
+        self._token = ''
+        self._unlocked = False
+        self._header = ''
+        self._need = 0
+        self._chunks = []
+        self._size = 0
+        conn.setblocking(0)
+        log("Waiting for client to unlock the connection...")
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def close(self):
+        self.conn.close()
+
+    def _recv(self, n):
+        """
+        Return up to n bytes from the client, '' if it closed the
+        connection, or None if there is nothing to read right now.
+        """
+        try:
+            return self.conn.recv(n)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+
+    def step(self):
+        """
+        Read what the client sent.  Returns (ConnectionJSON, message) once
+        the first message has arrived, with the connection blocking again
+        (with a timeout of CONTROL_TIMEOUT), None if that needs more data,
+        or False if the client failed and the connection was closed.
+        """
+        try:
+            return self._step()
+        except Exception, err:
+            log.error("Error receiving message: %s (connection terminated)"%err)
+            self.close()
+            return False
+
+    def _step(self):
+        if not self._unlocked:
+            if read_secret_token() is None:
+                refuse_conn(self.conn, "Unable to accept connection, since Sage server doesn't yet know the secret token; unable to read from '%s'"%secret_token_path)
+                return False
+            t = self._recv(len(secret_token) - len(self._token))
+            if t is None:
+                return None
+            self._token += t
+            if not t or self._token != secret_token[:len(self._token)]:
+                log("Client failed to unlock connection. Dumping them.")
+                refuse_conn(self.conn, "Invalid secret token.")  # no -- invalid login
+                return False
+            if len(self._token) < len(secret_token):
+                return None
+            self.conn.send('y') # yes -- valid login
+            self._unlocked = True
+            log("Connection unlocked.")
+        if len(self._header) < 4:
+            t = self._recv(4 - len(self._header))
+            if t is None:
+                return None
+            if not t:
+                raise EOFError
+            self._header += t
+            if len(self._header) < 4:
+                return None
+            self._need = struct.unpack('>L', self._header)[0]   # big endian 32 bits
+        while self._size < self._need:
+            t = self._recv(min(self._need - self._size, 65536))
+            if t is None:
+                return None
+            if not t:
+                raise EOFError
+            self._chunks.append(t)
+            self._size += len(t)
+        self.conn.settimeout(CONTROL_TIMEOUT)
+        conn = ConnectionJSON(self.conn)
+        typ, mesg = conn.decode(''.join(self._chunks))
+        if typ != 'json':
+            raise ValueError("the first message must be JSON, not a %s"%typ)
+        log("Received message %s"%mesg)
+        return conn, mesg
 
-    if mesg['event'] == 'send_signal':
-        if mesg['pid'] == 0:
-            log("invalid signal mesg (pid=0)")
+def handle_control(conn, mesg, status=None):
+    """
+    If mesg is a control message, handle it, close conn and return
+    True; otherwise return False.  The control messages are
+
+    - ``send_signal`` -- send signal to the process with the given pid
+    - ``ping`` -- reply with a pong
+    - ``sage_server_status`` -- reply with the message, with the dict
+      returned by status(memory) (if given) as its info; memory is true
+      if the message asks for the memory footprint of each process
+
+    Replies are best effort: the hub usually closes the connection right
+    after sending a signal.
+    """
+    event = mesg.get('event')
+    try:
+        if event == 'send_signal':
+            if not mesg.get('pid'):
+                log.warning("invalid signal mesg (pid=0)")
+            else:
+                log("Sending signal %s to %s"%(mesg['signal'], mesg['pid']))
+                try:
+                    os.kill(mesg['pid'], mesg['signal'])
+                except OSError, err:
+                    log.warning("unable to send signal %s to %s -- %s"%(mesg['signal'], mesg['pid'], err))
+        elif event == 'ping':
+            conn.send_json(message.pong(id=mesg.get('id')))
+        elif event == 'sage_server_status':
+            info = status(memory=bool(mesg.get('memory'))) if status is not None else None
+            conn.send_json(message.sage_server_status(id=mesg.get('id'), info=info))
         else:
-            log("Sending a signal")
-            os.kill(mesg['pid'], mesg['signal'])
-        return
-    if mesg['event'] != 'start_session':
-        log("Received an unknown message event = %s; terminating session."%mesg['event'])
-        return
+            return False
+    except socket.error, err:
+        log("control connection closed before the reply to %s was sent -- %s"%(event, err))
+    conn.close()
+    return True
 
+def start_session(conn, mesg, prepared=False, ready=None, zygote=None):
+    """
+    Run the session requested by the start_session message mesg, which
+    was received on the ConnectionJSON conn.  If the session was forked
+    from a zygote, zygote describes it for the session description.
+    """
+    global PID
+    PID = os.getpid()
     log("Starting a session")
-    desc = message.session_description(os.getpid())
+    if not prepared:
+        prepare_session()
+    params = mesg.get('params')
+    restored = None
+    if isinstance(params, dict) and params.get('restore'):
+        try:
+            restored = {'names':restore_namespace(project_path(params['restore']))}
+        except Exception, err:
+            log.error("unable to restore checkpoint '%s' -- %s"%(params['restore'], err))
+            restored = {'error':str(err)}
+    wire = conn.negotiate(params)
+    desc = message.session_description(os.getpid(), wire=wire, zygote=zygote, restored=restored)
     log("child sending session description back: %s"%desc)
     conn.send_json(desc)
+    # The description itself goes out in the default encoding, since
+    # that is how the hub learns what was negotiated.
+    conn.set_wire(wire)
+    if ready is not None:
+        ready()
     session(conn=conn)
 
-def serve(port, host):
+def serve_connection(conn, prepared=False, ready=None, accepted=None, status=None):
+    """
+    Unlock conn and handle the first message on it, which is either a
+    control message or starts a session.  Returns True if a session was
+    run, and False otherwise.
+
+    INPUT:
+
+    - ``conn`` -- a socket returned by accept
+    - ``prepared`` -- if True, prepare_session was already called in this process
+    - ``ready`` -- optional function called once a session is ready to run code
+    - ``accepted`` -- optional function called once it is known that the
+      connection is for a session
+    - ``status`` -- optional function returning the info for a
+      sage_server_status reply
+    """
+    log("Serving a connection")
+    first = recv_first_message(conn)
+    if first is None:
+        return False
+    conn, mesg = first
+    if handle_control(conn, mesg, status=status):
+        return False
+    if mesg['event'] != 'start_session':
+        log.warning("Received an unknown message event = %s; terminating session."%mesg['event'])
+        conn.close()
+        return False
+    if accepted is not None:
+        accepted()
+    conn._conn.settimeout(None)
+    start_session(conn, mesg, prepared=prepared, ready=ready)
+    return True
+
+# Number of exited children whose exit status ChildTable remembers.
+EXITED_CHILDREN_KEEP = 64
+
+class ChildTable(object):
+    """
+    The children of the server process, with when they started, what
+    they are for and, for recently exited ones, how they exited.
+
+    The server wakes up when a child exits because the SIGCHLD handler
+    writes to a pipe (see signal.set_wakeup_fd) that the accept loop
+    selects on, and then calls reap.  The handler must not be inherited
+    by children: installing one breaks pexpect and subprocess in Sage,
+    so after_fork restores the default.
+    """
+    def __init__(self):
+        self.live = {}   # pid --> {'pid':..., 'kind':..., 'start':...}
+        self.exited = collections.deque(maxlen=EXITED_CHILDREN_KEEP)
+        self._conns = {}
+        self._held = set()
+        self._wakeup, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self._wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def __len__(self):
+        return len(self.live)
+
+    def fileno(self):
+        """
+        A file descriptor that becomes readable when a child exits.
+        """
+        return self._wakeup
+
+    def after_fork(self):
+        """
+        Called in a newly forked child.
+        """
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        os.close(self._wakeup)
+        os.close(self._wakeup_w)
+        for conn in self._conns.values() + list(self._held):
+            conn.close()
+
+    def hold(self, conn):
+        """
+        Close conn, which the server itself is using, in children forked
+        until it is released.
+        """
+        self._held.add(conn)
+
+    def release(self, conn):
+        self._held.discard(conn)
+
+    def add(self, pid, kind, conn=None):
+        """
+        Record the child pid; conn, if given, is closed when it exits.
+        """
+        self.live[pid] = {'pid':pid, 'kind':kind, 'start':time.time()}
+        if conn is not None:
+            self._conns[pid] = conn
+
+    def reap(self):
+        """
+        Wait for all children that have exited, and return their entries.
+        """
+        try:
+            while os.read(self._wakeup, 4096):
+                pass
+        except OSError:
+            pass   # drained
+        reaped = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                break   # ECHILD
+            if not pid:
+                break
+            c = self.live.pop(pid, {'pid':pid, 'kind':'unknown', 'start':None})
+            c['end'] = time.time()
+            if os.WIFSIGNALED(status):
+                c['signal'] = os.WTERMSIG(status)
+            else:
+                c['exitcode'] = os.WEXITSTATUS(status)
+            conn = self._conns.pop(pid, None)
+            if conn is not None:
+                conn.close()
+            log("child %s terminated -- %s"%(pid, c))
+            self.exited.append(c)
+            reaped.append(c)
+        return reaped
+
+    def stats(self):
+        """
+        Return a JSON-able description of the live and recently exited children.
+        """
+        now = time.time()
+        live = [dict(c, age=now - c['start']) for c in self.live.itervalues()]
+        return {'live':sorted(live, key=lambda c: c['start']), 'exited':list(self.exited)}
+
+class SessionPool(object):
+    """
+    A pool of pre-forked children that have already called
+    prepare_session and wait in accept on the listening socket, so a new
+    connection doesn't pay for fork and initialization.
+
+    Children tell the parent what they are doing by writing one line per
+    event to a shared pipe (writes that small are atomic):
+
+    - ``accept <pid>`` -- a warm child took a connection for a session; the
+      parent refills (control connections don't use up a warm child)
+    - ``ready <hit|miss> <seconds>`` -- a session became ready that many
+      seconds after its connection was accepted
+
+    A miss is a connection the parent had to accept and fork for itself
+    because no warm child was idle.
+
+    The parent selects on fileno() and calls handle_events when it is
+    readable, and calls forget for each child reaped by the ChildTable.
+    """
+    def __init__(self, sock, size, children, status=None):
+        self._sock = sock
+        self._size = size
+        self._children = children
+        self._status = status
+        self._parent = os.getpid()
+        self._events, self._events_w = os.pipe()
+        self._partial = ''
+        self.idle = set()   # pids of warm children waiting in accept
+        self.hits = 0
+        self.misses = 0
+        self._latency = {'hit':[0, 0.0, 0.0], 'miss':[0, 0.0, 0.0]}   # count, total, max
+
+    def __repr__(self):
+        return "SessionPool(%s)"%self.stats()
+
+    def stats(self):
+        """
+        Return a JSON-able dict with the pool size, number of idle warm
+        children, hit/miss counts and session-ready latencies.
+        """
+        s = {'size':self._size, 'idle':len(self.idle), 'hits':self.hits, 'misses':self.misses}
+        for kind, (count, total, worst) in self._latency.iteritems():
+            s['%s_latency'%kind] = {'count':count, 'mean':total/count if count else 0, 'max':worst}
+        return s
+
+    def report(self, event, *args):
+        """
+        Called in a child to report an event to the parent.
+        """
+        try:
+            os.write(self._events_w, ' '.join([event] + [str(x) for x in args]) + '\n')
+        except OSError, err:
+            log.error("unable to report pool event %s -- %s"%(event, err))
+
+    def ready_callback(self, kind, accept_time):
+        return lambda: self.report('ready', kind, time.time() - accept_time)
+
+    def fill(self):
+        """
+        Fork warm children until there are size of them idle.
+        """
+        while len(self.idle) < self._size:
+            log.flush()
+            try:
+                pid = os.fork()
+            except OSError, err:
+                log.error("pool: unable to fork a warm child -- %s"%err)
+                return
+            if pid:
+                self.idle.add(pid)
+                self._children.add(pid, 'warm')
+            else:
+                self._warm_child()
+
+    def _warm_child(self):
+        global PID
+        PID = os.getpid()
+        log.after_fork()
+        self._children.after_fork()
+        # wake up every few seconds to check that the server is still there
+        self._sock.settimeout(5)
+        try:
+            prepare_session()
+            while True:
+                if os.getppid() != self._parent:
+                    # the server died; nobody will ever route a connection to us
+                    os._exit(0)
+                try:
+                    conn, addr = self._sock.accept()
+                except socket.error:
+                    # timeout, or another process accepted the connection first
+                    continue
+                t = time.time()
+                log("warm child accepted a connection from", addr)
+                # A control message is handled right here, after which we are
+                # still warm and go back to waiting for a session.  As in the
+                # parent, a client that never unlocks the connection mustn't
+                # keep us out of accept forever.
+                conn.settimeout(CONTROL_TIMEOUT)
+                try:
+                    if serve_connection(conn, prepared=True, ready=self.ready_callback('hit', t),
+                                        accepted=lambda: self.report('accept', PID), status=self._status):
+                        break
+                except (socket.error, EOFError), err:
+                    # e.g. timed out; we are still warm
+                    log.error("warm child: error handling a new connection -- %s"%err)
+                    conn.close()
+                log.flush()
+        except:
+            log.error("warm child error -- %s"%traceback.format_exc())
+        finally:
+            log.flush()
+            os._exit(0)
+
+    def fileno(self):
+        return self._events
+
+    def handle_events(self):
+        data = self._partial + os.read(self._events, 4096)
+        lines = data.split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            v = line.split()
+            if v[0] == 'accept':
+                pid = int(v[1])
+                self.idle.discard(pid)
+                if pid in self._children.live:
+                    self._children.live[pid]['kind'] = 'session'
+                self.hits += 1
+            elif v[0] == 'ready':
+                latency = float(v[2])
+                z = self._latency[v[1]]
+                z[0] += 1; z[1] += latency; z[2] = max(z[2], latency)
+        log("pool: %s"%self.stats())
+
+    def forget(self, pid):
+        """
+        Called when the child pid has exited.
+        """
+        self.idle.discard(pid)
+
+# Run by init_library in the server after importing sage, so sessions don't
+# pay for them: (name, statement) pairs.  Imports named in the lazy_imports
+# argument of serve are instead bound to a LazyModule, and the WARMUP_STEPS,
+# which only fill caches, can be skipped.
+INIT_LIBRARY_STEPS = [
+    ('sage.all',  'from sage.all import *'),
+    ('x',         'from sage.calculus.predefined import x'),
+    ('scipy',     'import scipy'),
+    ('sympy',     'import sympy'),
+    ('pylab',     'import pylab'),
+    ('plot',      "plot(sin).save('%s/a.png'%os.environ['SAGEMATHCLOUD'], figsize=2)"),
+    ('integrate', 'integrate(sin(x**2),x)')]
+WARMUP_STEPS = ('plot', 'integrate')
+
+# The modules imported lazily with --lazy_imports=default.
+LAZY_IMPORTS = ('scipy', 'sympy')
+
+# The steps that can be made lazy: those that just import the module of the same name.
+LAZY_IMPORTABLE = tuple([name for name, cmd in INIT_LIBRARY_STEPS if cmd == 'import %s'%name])
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for the module name in a namespace until one of its
+    attributes is used; then the module is imported and replaces the
+    LazyModule in the namespace.
+
+    In the server this means a session that never uses the module
+    doesn't pay for importing it, and one that does pays in its first
+    cell that needs it (the time is logged).
+    """
+    def __init__(self, name, namespace=None):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_lazy_namespace'] = namespace
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_resolve(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            name = self.__name__
+            t = time.time()
+            __import__(name)
+            module = self.__dict__['_lazy_module'] = sys.modules[name]
+            namespace = self.__dict__['_lazy_namespace']
+            if namespace is not None and namespace.get(name) is self:
+                namespace[name] = module
+            log("lazily imported %s in %.3f seconds"%(name, time.time() - t))
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_resolve(), attr, value)
+
+    def __dir__(self):
+        return dir(self._lazy_resolve())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is not None:
+            return repr(self.__dict__['_lazy_module'])
+        return "<lazy module '%s'>"%self.__name__
+
+def lazy_import(name, namespace=None):
+    """
+    Return the module name if it is already imported, and otherwise a
+    LazyModule for it.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name, namespace)
+
+class StartupProfile(object):
+    """
+    Timings of the steps of init_library, and, if imports is True, of
+    every module imported while it runs (by wrapping __import__).
+
+    Import times are exclusive: the time spent importing a module minus
+    the time spent importing the modules it imports, as with python -X
+    importtime.
+    """
+    def __init__(self, imports=False):
+        self.steps = []       # (name, seconds), in order
+        self.imports = {} if imports else None    # name --> [count, seconds]
+        self._stack = []
+
+    @contextlib.contextmanager
+    def step(self, name):
+        t = time.time()
+        if self.imports is not None:
+            import __builtin__
+            orig = __builtin__.__import__
+            __builtin__.__import__ = self._wrap_import(orig)
+        try:
+            yield
+        finally:
+            if self.imports is not None:
+                __builtin__.__import__ = orig
+            t = time.time() - t
+            self.steps.append((name, t))
+            log("init_library: %s took %.3f seconds"%(name, t))
+
+    def _wrap_import(self, orig):
+        stack = self._stack
+        imports = self.imports
+        def _import(name, globals=None, locals=None, fromlist=None, level=-1):
+            n = len(sys.modules)
+            stack.append(0.0)     # time spent in nested imports
+            t = time.time()
+            module = None
+            try:
+                module = orig(name, globals, locals, fromlist, level)
+                return module
+            finally:
+                t = time.time() - t
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += t
+                if len(sys.modules) > n:    # actually imported something
+                    # Name it by what was imported, since name may be relative.
+                    full = getattr(module, '__name__', None) or name
+                    if not fromlist and '.' in name:
+                        full += name[name.index('.'):]
+                    z = imports.setdefault(full, [0, 0.0])
+                    z[0] += 1
+                    z[1] += t - nested
+        return _import
+
+    def stats(self, top=20):
+        """
+        Return a JSON-able dict with the step timings, and the top slowest imports.
+        """
+        s = {'steps':self.steps, 'total':sum(t for _, t in self.steps)}
+        if self.imports is not None:
+            v = sorted(self.imports.iteritems(), key=lambda x: -x[1][1])[:top]
+            s['imports'] = [(name, t) for name, (count, t) in v]
+        return s
+
+    def report(self, top=20):
+        """
+        Return the stats as a human readable string.
+        """
+        s = self.stats(top)
+        lines = ["startup profile (%.3f seconds total)"%s['total']]
+        lines += ["  %-30s %8.3f"%(name, t) for name, t in s['steps']]
+        if 'imports' in s:
+            lines.append("slowest imports (exclusive time)")
+            lines += ["  %-30s %8.3f"%(name, t) for name, t in s['imports']]
+        return '\n'.join(lines)
+
+# Sessions for a project can be forked from a "zygote": a child of the
+# server that has already run the project's initialization cells, e.g., the
+# %auto cells of a worksheet.  The hub asks for this with the start_session
+# params {'zygote':{'project':project_id, 'cells':[code, ...]}}.
+ZYGOTE_MAX = 8                # keep at most this many zygotes (the least recently used is evicted)
+ZYGOTE_IDLE_TIMEOUT = 3600    # evict zygotes that haven't started a session for this many seconds
+ZYGOTE_MIN_AVAILABLE = 0.1    # evict idle zygotes while less than this fraction of memory is available
+ZYGOTE_CHECK_INTERVAL = 30    # how often (in seconds) to check the above while there are zygotes
+
+def memory_available():
+    """
+    Return the fraction of the memory of this machine that is available
+    for new allocations, according to /proc/meminfo, or None if unknown.
+    """
+    try:
+        info = {}
+        for line in open('/proc/meminfo'):
+            v = line.split()
+            info[v[0].rstrip(':')] = int(v[1])
+        return float(info['MemAvailable']) / info['MemTotal']
+    except (IOError, KeyError, ValueError, IndexError, ZeroDivisionError):
+        return None
+
+# The fields of /proc/<pid>/smaps reported by memory_footprint.
+SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty', 'Swap')
+
+def memory_footprint(pid):
+    """
+    Return a dict with the Rss, Pss, shared and private (clean and dirty)
+    and Swap memory of the process pid, in kilobytes, from
+    /proc/<pid>/smaps (or smaps_rollup, which is much faster to read on
+    Linux >= 4.14), or None if they can't be read.
+
+    For a session forked from the server, the shared memory is what it
+    still shares with the server (and other sessions), and Private_Dirty
+    is what copy on write has cost so far.
+    """
+    m = dict((k, 0) for k in SMAPS_FIELDS)
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            f = open('/proc/%s/%s'%(pid, name))
+        except IOError:
+            continue
+        try:
+            for line in f:
+                v = line.split()
+                if len(v) == 3 and v[2] == 'kB':
+                    k = v[0][:-1]
+                    if k in m:
+                        m[k] += int(v[1])
+        except (IOError, ValueError):
+            return None
+        finally:
+            f.close()
+        m['Shared'] = m['Shared_Clean'] + m['Shared_Dirty']
+        m['Private'] = m['Private_Clean'] + m['Private_Dirty']
+        return m
+    return None
+
+# With gc_freeze, the server collects garbage once after importing the Sage
+# library, and then raises the threshold of the oldest generation to this,
+# so neither it nor the sessions forked from it (which inherit the setting)
+# run full collections automatically.  A full collection writes to the
+# header of every tracked object, so in a session it copies almost all of
+# the pre-fork heap.
+GC_FREEZE_THRESHOLD = 2**31 - 1
+
+# Cyclic garbage made by the cells of a session would then never be freed,
+# so a session still runs a full collection after a cell if this many
+# seconds have passed since it started or last ran one.
+GC_FREEZE_COLLECT_INTERVAL = 300
+
+def freeze_gc():
+    """
+    Collect all garbage now and turn off automatic full collections.
+    Young objects are still collected as usual; cyclic garbage that
+    survives into the oldest generation is only freed by an explicit
+    gc.collect(), which sessions run in collect_frozen_gc.
+    """
+    gc.collect()
+    t0, t1, t2 = gc.get_threshold()
+    gc.set_threshold(t0, t1, GC_FREEZE_THRESHOLD)
+
+# When the session last ran a full collection (see collect_frozen_gc).
+gc_collect_time = None
+
+def collect_frozen_gc():
+    """
+    Called by a session after each cell: if freeze_gc turned off
+    automatic full collections, run one every GC_FREEZE_COLLECT_INTERVAL
+    seconds.
+    """
+    global gc_collect_time
+    if gc.get_threshold()[2] != GC_FREEZE_THRESHOLD:
+        return
+    now = time.time()
+    if gc_collect_time is None:
+        gc_collect_time = now
+    elif now - gc_collect_time >= GC_FREEZE_COLLECT_INTERVAL:
+        t = time.time()
+        n = gc.collect()
+        gc_collect_time = time.time()
+        log("full garbage collection freed %s objects in %.3f seconds"%(n, gc_collect_time - t))
+
+def add_memory_footprints(info):
+    """
+    Add the memory_footprint of the server and of each of its live
+    children to the status dict info (see serve), with totals.
+    """
+    info['memory'] = memory_footprint(info['pid'])
+    total = dict((k, 0) for k in SMAPS_FIELDS + ('Shared', 'Private'))
+    for c in info['children']['live']:
+        c['memory'] = m = memory_footprint(c['pid'])
+        if m is not None:
+            for k in total:
+                total[k] += m[k]
+    info['children']['memory'] = total
+
+class NullConnection(object):
+    """
+    Stands in for the hub connection while a zygote runs initialization
+    cells: output is discarded (stderr is logged) and there are never
+    any incoming messages.
+    """
+    def close(self):
+        pass
+
+    def send_json(self, m):
+        if m.get('stderr'):
+            log.warning("zygote: ", truncate_text(m['stderr'], 1024))
+
+    def send_blob(self, blob):
+        return uuidsha1(blob)
+
+    def send_file(self, filename, chunk_size=BLOB_CHUNK_SIZE, sha1=None):
+        if sha1 is not None:
+            return sha1
+        f = open(filename, 'rb')
+        try:
+            return uuidsha1_file(f, chunk_size)[0]
+        finally:
+            f.close()
+
+    def recv(self):
+        raise EOFError
+
+class Zygote(object):
+    """
+    The server's end of a zygote for one project.
+
+    The server hands a connection to the zygote by sending its file
+    descriptor over a unix socket, followed by the start_session message.
+    The zygote forks a session for it, which it reaps itself, and tells
+    the server about it with a 'zygote_forked' message.  It sends
+    'zygote_ready' once it has run the cells; until then sessions for the
+    project are forked by the server as usual.
+    """
+    def __init__(self, project, key, cells):
+        self.project = project
+        self.key = key
+        self.cells = cells
+        self.pid = None
+        self.ready = False
+        self.created = self.last_used = time.time()
+        self.sessions = 0
+        self._sock, self._child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn = ConnectionJSON(self._sock)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self.conn.close()
+
+    def stats(self):
+        return {'project':self.project, 'pid':self.pid, 'ready':self.ready, 'cells':len(self.cells),
+                'sessions':self.sessions, 'age':time.time() - self.created,
+                'idle':time.time() - self.last_used}
+
+    def handle_message(self):
+        """
+        Handle a message from the zygote; returns False if it is gone.
+        """
+        try:
+            typ, mesg = self.conn.recv()
+        except (EOFError, socket.error):
+            return False
+        if mesg['event'] == 'zygote_ready':
+            log("zygote %s for project %s ready after %.3f seconds"%(self.pid, self.project, mesg['time']))
+            self.ready = True
+        elif mesg['event'] == 'zygote_forked':
+            log("zygote %s forked session %s"%(self.pid, mesg['pid']))
+        return True
+
+    def start_session(self, conn, mesg):
+        """
+        Have the zygote run the session for the ConnectionJSON conn, which
+        sent the start_session message mesg.  Returns False if that isn't
+        possible, in which case conn is still ours.
+        """
+        if not self.ready:
+            return False
+        try:
+            _multiprocessing.sendfd(self.fileno(), conn._conn.fileno())
+            self.conn.send_json(mesg)
+        except (OSError, socket.error), err:
+            log.error("unable to hand a session to zygote %s -- %s"%(self.pid, err))
+            self.ready = False
+            return False
+        conn.close()
+        self.sessions += 1
+        self.last_used = time.time()
+        return True
+
+    def run(self):
+        """
+        The zygote process: run the cells, then fork sessions on request.
+        """
+        global PID
+        PID = os.getpid()
+        self._sock.close()
+        sock = self._child_sock
+        conn = ConnectionJSON(sock)
+        t = time.time()
+        null = NullConnection()
+        mq = MessageQueue(null)
+        for code in self.cells:
+            try:
+                execute(conn=null, id=uuid(), code=code, data=None, cell_id=None,
+                        preparse=True, message_queue=mq)
+            except Exception, err:
+                log.error("zygote: error running initialization cell -- %s"%err)
+        conn.send_json({'event':'zygote_ready', 'time':time.time() - t})
+        description = {'project':self.project, 'cells':len(self.cells)}
+
+        sessions = ChildTable()
+        while True:
+            try:
+                r, _, _ = select.select([sock, sessions], [], [])
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            if sessions in r:
+                sessions.reap()
+            if sock not in r:
+                continue
+            try:
+                fd = _multiprocessing.recvfd(sock.fileno())
+                typ, mesg = conn.recv()
+            except (EOFError, OSError, RuntimeError, socket.error):   # RuntimeError: no fd
+                log("zygote: the server closed the connection")
+                return
+            log.flush()
+            pid = os.fork()
+            if pid:
+                os.close(fd)
+                sessions.add(pid, 'session')
+                conn.send_json({'event':'zygote_forked', 'pid':pid})
+                continue
+            try:
+                PID = os.getpid()
+                log.after_fork()
+                sessions.after_fork()
+                sock.close()
+                session_sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+                os.close(fd)
+                start_session(ConnectionJSON(session_sock), mesg, zygote=description)
+            except SystemExit:
+                pass
+            except:
+                log.error("zygote session error -- %s"%traceback.format_exc())
+            finally:
+                log.flush()
+                os._exit(0)
+
+class ZygoteTable(object):
+    """
+    The zygotes of the server, by project (at most one per project).
+    """
+    def __init__(self, children, max_zygotes=ZYGOTE_MAX):
+        self._children = children
+        self._max = max_zygotes
+        self._zygotes = {}   # project --> Zygote
+
+    def __len__(self):
+        return len(self._zygotes)
+
+    def zygotes(self):
+        return self._zygotes.values()
+
+    def stats(self):
+        return {'max':self._max, 'zygotes':[z.stats() for z in self._zygotes.itervalues()]}
+
+    def start_session(self, conn, mesg):
+        """
+        If mesg asks for a zygote, have a ready zygote for the project run
+        the session on conn and return True.  Otherwise (also when the
+        zygote is still starting, which this may do) return False.
+        """
+        params = mesg.get('params')
+        z = params.get('zygote') if isinstance(params, dict) else None
+        if not self._max or not isinstance(z, dict) or not z.get('project'):
+            return False
+        project = z['project']
+        cells = [unicode8(c) for c in z.get('cells', [])]
+        key = uuidsha1(json.dumps(cells))
+        zygote = self._zygotes.get(project)
+        if zygote is not None and zygote.key != key:
+            log("initialization cells of project %s changed"%project)
+            self.evict(zygote)
+            zygote = None
+        if zygote is None:
+            available = memory_available()
+            if available is None or available >= ZYGOTE_MIN_AVAILABLE:
+                self.spawn(project, key, cells)
+            return False
+        return zygote.start_session(conn, mesg)
+
+    def spawn(self, project, key, cells):
+        while len(self._zygotes) >= self._max:
+            self.evict(min(self._zygotes.itervalues(), key=lambda z: z.last_used))
+        zygote = Zygote(project, key, cells)
+        log.flush()
+        try:
+            pid = os.fork()
+        except OSError, err:
+            log.error("unable to fork a zygote -- %s"%err)
+            zygote.close()
+            return
+        if pid:
+            zygote._child_sock.close()
+            zygote.pid = pid
+            self._zygotes[project] = zygote
+            self._children.add(pid, 'zygote', zygote)
+            log("forked zygote %s for project %s"%(pid, project))
+        else:
+            log.after_fork()
+            self._children.after_fork()
+            try:
+                zygote.run()
+            except:
+                log.error("zygote error -- %s"%traceback.format_exc())
+            finally:
+                log.flush()
+                os._exit(0)
+
+    def evict(self, zygote):
+        """
+        Stop the zygote; the sessions it forked are not affected.
+        """
+        log("evicting zygote %s of project %s"%(zygote.pid, zygote.project))
+        if self._zygotes.get(zygote.project) is zygote:
+            del self._zygotes[zygote.project]
+        zygote.close()
+        try:
+            os.kill(zygote.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def forget(self, pid):
+        """
+        Called when the child pid has exited.
+        """
+        for zygote in self._zygotes.values():
+            if zygote.pid == pid:
+                del self._zygotes[zygote.project]
+
+    def handle(self, zygote):
+        """
+        Called when the zygote's socket is readable.
+        """
+        if not zygote.handle_message():
+            self.evict(zygote)
+
+    def check(self):
+        """
+        Evict zygotes that have been idle too long, and idle zygotes
+        (least recently used first) while memory is short.
+        """
+        now = time.time()
+        for zygote in self._zygotes.values():
+            if now - zygote.last_used > ZYGOTE_IDLE_TIMEOUT:
+                self.evict(zygote)
+        while self._zygotes:
+            available = memory_available()
+            if available is None or available >= ZYGOTE_MIN_AVAILABLE:
+                break
+            log.warning("only %.1f%% of memory available"%(100*available))
+            self.evict(min(self._zygotes.itervalues(), key=lambda z: z.last_used))
+
+def serve(port, host, pool_size=0, lazy_imports=(), warmup=True, profile_imports=False, max_zygotes=0,
+          gc_freeze=False):
     #log.info('opening connection on port %s', port)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # check for children that have finished every few seconds, so
-    # we don't end up with zombies.
-    s.settimeout(5)
+    # We only accept once select says a connection is waiting, but a warm
+    # child may take it first, so accept must not block.
+    s.setblocking(0)
 
     s.bind((host, port))
     log('Sage server %s:%s'%(host, port))
 
-    # Enabling the following signal completely breaks subprocess pexpect in many cases, which is
-    # obviously totally unacceptable.
-    #signal.signal(signal.SIGCHLD, handle_session_term)
-
     def init_library():
         tm = time.time()
         log("pre-importing the sage library...")
@@ -1528,7 +4286,8 @@ def serve(port, host):
         # Actually import sage now.  This must happen after the interact
         # import because of library interacts.
         log("import sage...")
-        import sage.all
+        with profile.step('import sage.all'):
+            import sage.all
 
         # Monkey patch the html command.
         import sage.interacts.library
@@ -1543,15 +4302,20 @@ def serve(port, host):
 
         # Plot, integrate, etc., -- so startup time of worksheets is minimal.
 
-        for cmd in ['from sage.all import *',
-                    'from sage.calculus.predefined import x',
-                    'import scipy',
-                    'import sympy',
-                    'import pylab',
-                    "plot(sin).save('%s/a.png'%os.environ['SAGEMATHCLOUD'], figsize=2)",
-                    'integrate(sin(x**2),x)']:
+        for name in lazy_imports:
+            if name not in LAZY_IMPORTABLE:
+                log.warning("can't import %s lazily; only %s can be"%(name, ', '.join(LAZY_IMPORTABLE)))
+        for name, cmd in INIT_LIBRARY_STEPS:
+            if name in lazy_imports and name in LAZY_IMPORTABLE:
+                log("lazy import of %s"%name)
+                namespace[name] = lazy_import(name, namespace)
+                continue
+            if not warmup and name in WARMUP_STEPS:
+                log("skipping %s"%name)
+                continue
             log(cmd)
-            exec cmd in namespace
+            with profile.step(name):
+                exec cmd in namespace
 
         global pylab
         pylab = namespace['pylab']     # used for clearing
@@ -1586,7 +4350,12 @@ def serve(port, host):
         namespace['__SAGEWS__'] = True
 
     log("Initialize sage library.")
+    profile = StartupProfile(imports=profile_imports)
     init_library()
+    if gc_freeze:
+        with profile.step('gc freeze'):
+            freeze_gc()
+    log(profile.report())
 
     t = time.time()
     s.listen(128)
@@ -1598,44 +4367,153 @@ def serve(port, host):
     except Exception, err:
         log("Not writing sage_server.port file --", err)
 
-    children = {}
+    # The status of the server and its children is also kept in this file
+    # for monitoring, and warm children reply to sage_server_status with it.
+    status_file = os.path.join(DATA_PATH, "sage_server.status")
+    start_time = time.time()
+
+    def status(memory=False):
+        now = time.time()
+        info = {'pid':os.getpid(), 'time':now, 'uptime':now - start_time,
+                'sessions':len(children), 'children':children.stats(), 'startup':profile.stats(),
+                'gc_freeze':gc_freeze}
+        if pool is not None:
+            info['pool'] = pool.stats()
+        if max_zygotes:
+            info['zygotes'] = zygotes.stats()
+        if memory:
+            add_memory_footprints(info)
+        return info
+
+    def write_status():
+        try:
+            tmp = status_file + '.tmp'
+            open(tmp, 'w').write(json.dumps(status()))
+            os.rename(tmp, status_file)
+        except Exception, err:
+            log.error("unable to write %s -- %s"%(status_file, err))
+
+    def read_status(memory=False):
+        info = json.load(open(status_file))
+        if memory:
+            add_memory_footprints(info)
+        return info
+
+    children = ChildTable()
+    pool = SessionPool(s, pool_size, children, status=read_status) if pool_size > 0 else None
+    zygotes = ZygoteTable(children, max_zygotes)
+
     log("Starting server listening for connections")
+    # Connections whose client hasn't unlocked it and sent the first message yet.
+    handshakes = set()
     try:
         while True:
             i += 1
-            #print i, time.time()-t, 'cps: ', int(i/(time.time()-t))
             # do not use log.info(...) in the server loop; threads = race conditions that hang server every so often!!
+            for c in children.reap():
+                if pool is not None:
+                    pool.forget(c['pid'])
+                zygotes.forget(c['pid'])
+            zygotes.check()
+            now = time.time()
+            for h in [h for h in handshakes if h.deadline <= now]:
+                log("Client didn't send its first message within %s seconds. Dumping them."%CONTROL_TIMEOUT)
+                handshakes.discard(h); children.release(h)
+                h.close()
+            r = [children] + zygotes.zygotes() + list(handshakes)
+            if pool is not None:
+                pool.fill()
+                r.append(pool)
+            if pool is None or not pool.idle:
+                # otherwise warm children take the connections
+                r.append(s)
+            write_status()
+            timeout = ZYGOTE_CHECK_INTERVAL if len(zygotes) else None
+            if handshakes:
+                wait = min([h.deadline for h in handshakes]) - now
+                timeout = max(0, wait if timeout is None else min(timeout, wait))
             try:
-                if children:
-                    for pid in children.keys():
-                        if os.waitpid(pid, os.WNOHANG) != (0,0):
-                            log("subprocess %s terminated, closing connection"%pid)
-                            conn.close()
-                            del children[pid]
-
+                r, _, _ = select.select(r, [], [], timeout)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            if pool is not None and pool in r:
+                pool.handle_events()
+            for zygote in zygotes.zygotes():
+                if zygote in r:
+                    zygotes.handle(zygote)
+            if s in r:
                 try:
                     conn, addr = s.accept()
                     log("Accepted a connection from", addr)
-                except:
-                    # this will happen periodically since we did s.settimeout above, so
-                    # that we wait for children above periodically.
+                    h = Handshake(conn, addr, time.time())
+                    handshakes.add(h); children.hold(h)
+                    r.append(h)   # the client usually sent the token already
+                except socket.error, msg:
+                    # a warm child took it first, or the client already gave up
+                    pass
+
+            # The token and first message are read as they arrive, so one
+            # slow client doesn't keep the others waiting.  Control messages
+            # are handled right here; forking the whole Sage process just to
+            # send a signal is expensive.
+            for h in handshakes.intersection(r):
+                first = h.step()
+                if first is None:
                     continue
-            except socket.error, msg:
-                continue
-            child_pid = os.fork()
-            if child_pid: # parent
-                log("forked off child with pid %s to handle this connection"%child_pid)
-                children[child_pid] = conn
-            else:
-                # child
-                global PID
-                PID = os.getpid()
-                log("child process, will now serve this new connection")
-                serve_connection(conn)
+                handshakes.discard(h)
+                if not first:
+                    children.release(h)
+                    continue
+                conn, mesg = first
+                # h is held until the finally below, so a zygote that
+                # zygotes.start_session forks doesn't inherit conn.
+                try:
+                    if handle_control(conn, mesg, status=status):
+                        continue
+                    if mesg.get('event') != 'start_session':
+                        log.warning("Received an unknown message event = %s; closing connection."%mesg.get('event'))
+                        conn.close()
+                        continue
+                    conn._conn.settimeout(None)
+                    if zygotes.start_session(conn, mesg):
+                        continue
+                except Exception, err:
+                    log.error("Error handling a new connection -- %s"%err)
+                    try:
+                        conn.close()
+                    except:
+                        pass
+                    continue
+                finally:
+                    children.release(h)
+
+                if pool is not None:
+                    pool.misses += 1
+                log.flush()
+                child_pid = os.fork()
+                if child_pid: # parent
+                    log("forked off child with pid %s to handle this connection"%child_pid)
+                    children.add(child_pid, 'session', conn)
+                else:
+                    # child
+                    global PID
+                    PID = os.getpid()
+                    log.after_fork()
+                    children.after_fork()
+                    log("child process, will now serve this new connection")
+                    try:
+                        start_session(conn, mesg, ready=pool.ready_callback('miss', h.accept_time) if pool is not None else None)
+                    except:
+                        log.error("session error -- %s"%traceback.format_exc())
+                    finally:
+                        log.flush()
+                        os._exit(0)
 
         # end while
     except Exception, err:
-        log("Error taking connection: ", err)
+        log.error("Error taking connection: ", err)
         traceback.print_exc(file=sys.stdout)
         #log.error("error: %s %s", type(err), str(err))
 
@@ -1644,15 +4522,18 @@ def serve(port, host):
         #s.shutdown(0)
         s.close()
 
-def run_server(port, host, pidfile):
+def run_server(port, host, pidfile, pool_size=0, lazy_imports=(), warmup=True, profile_imports=False,
+               max_zygotes=0, gc_freeze=False):
     if pidfile:
         open(pidfile,'w').write(str(os.getpid()))
     if logfile:
         #log.addHandler(logging.FileHandler(logfile))
         pass
-    log("run_server: port=%s, host=%s, pidfile='%s', logfile='%s'"%(port, host, pidfile, logfile))
+    log("run_server: port=%s, host=%s, pidfile='%s', logfile='%s', pool_size=%s, lazy_imports=%s"%(
+        port, host, pidfile, logfile, pool_size, lazy_imports))
     try:
-        serve(port, host)
+        serve(port, host, pool_size=pool_size, lazy_imports=lazy_imports, warmup=warmup,
+              profile_imports=profile_imports, max_zygotes=max_zygotes, gc_freeze=gc_freeze)
     finally:
         if pidfile:
             os.unlink(pidfile)
@@ -1663,7 +4544,7 @@ if __name__ == "__main__":
     parser.add_argument("-p", dest="port", type=int, default=0,
                         help="port to listen on (default: 0); 0 = automatically allocated; saved to $SAGEMATHCLOUD/data/sage_server.port")
     parser.add_argument("-l", dest='log_level', type=str, default='INFO',
-                        help="log level (default: INFO) useful options include WARNING and DEBUG")
+                        help="log level, one of %s (default: INFO)"%', '.join(Logger.LEVELS))
     parser.add_argument("-d", dest="daemon", default=False, action="store_const", const=True,
                         help="daemon mode (default: False)")
     parser.add_argument("--host", dest="host", type=str, default='127.0.0.1',
@@ -1678,6 +4559,25 @@ if __name__ == "__main__":
                         help="hostname to connect to in client mode")
     parser.add_argument("--portfile", dest="portfile", type=str, default='',
                         help="write port to this file")
+    parser.add_argument("--pool_size", dest="pool_size", type=int, default=0,
+                        help="number of pre-forked initialized children waiting for connections (default: 0 = fork on accept)")
+    parser.add_argument("--log_flush_interval", dest="log_flush_interval", type=float, default=0,
+                        help="flush the log from a background thread every this many seconds (default: 0 = only when logging)")
+    parser.add_argument("--log_max_bytes", dest="log_max_bytes", type=int, default=0,
+                        help="rotate the log file when it exceeds this many bytes (default: 0 = never)")
+    parser.add_argument("--log_backup_count", dest="log_backup_count", type=int, default=1,
+                        help="number of rotated log files to keep (default: 1)")
+    parser.add_argument("--lazy_imports", dest="lazy_imports", type=str, default='',
+                        help="comma separated modules (of %s) to import on first use instead of at startup; 'default' = %s (default: '' = none)"%(
+                            ', '.join(LAZY_IMPORTABLE), ','.join(LAZY_IMPORTS)))
+    parser.add_argument("--no_warmup", dest="warmup", default=True, action="store_const", const=False,
+                        help="don't plot and integrate at startup to warm up caches (default: warm up)")
+    parser.add_argument("--zygotes", dest="zygotes", type=int, default=0,
+                        help="maximum number of per-project zygotes, which fork sessions that have already run the project's initialization cells (default: 0 = none)")
+    parser.add_argument("--gc_freeze", dest="gc_freeze", default=False, action="store_const", const=True,
+                        help="collect garbage once at startup and then disable automatic full collections, so forked sessions don't copy the pre-imported heap; sessions instead run one after a cell at most every %s seconds (default: False)"%GC_FREEZE_COLLECT_INTERVAL)
+    parser.add_argument("--profile_imports", dest="profile_imports", default=False, action="store_const", const=True,
+                        help="include the time of every module imported at startup in the startup profile")
 
     args = parser.parse_args()
 
@@ -1686,9 +4586,19 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if args.log_level:
-        pass
-        #level = getattr(logging, args.log_level.upper())
-        #log.setLevel(level)
+        try:
+            log.set_level(args.log_level)
+        except ValueError:
+            parser.error("argument -l: invalid log level '%s' (choose from %s)"%(args.log_level, ', '.join(Logger.LEVELS)))
+
+    lazy_imports = LAZY_IMPORTS if args.lazy_imports == 'default' else \
+                   tuple([name.strip() for name in args.lazy_imports.split(',') if name.strip()])
+    for name in lazy_imports:
+        if name not in LAZY_IMPORTABLE:
+            parser.error("argument --lazy_imports: can't import '%s' lazily (choose from %s)"%(name, ', '.join(LAZY_IMPORTABLE)))
+
+    log.max_bytes = args.log_max_bytes
+    log.backup_count = args.log_backup_count
 
     if args.client:
         client1(port=args.port if args.port else int(open(args.portfile).read()), hostname=args.hostname)
@@ -1709,10 +4619,16 @@ if __name__ == "__main__":
     logfile = os.path.abspath(args.logfile) if args.logfile else ''
     if logfile:
         LOGFILE = logfile
-        open(LOGFILE, 'w')  # for now we clear it on restart...
+        log.set_file(LOGFILE, truncate=True)  # for now we clear it on restart...
         log("setting logfile to %s"%LOGFILE)
 
-    main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile)
+    def main():
+        # started here, since daemonizing forks and only the forking thread survives
+        if args.log_flush_interval > 0:
+            log.start_background(args.log_flush_interval)
+        run_server(port=args.port, host=args.host, pidfile=pidfile, pool_size=args.pool_size,
+                   lazy_imports=lazy_imports, warmup=args.warmup, profile_imports=args.profile_imports,
+                   max_zygotes=args.zygotes, gc_freeze=args.gc_freeze)
     if args.daemon and args.pidfile:
         import daemon
         daemon.daemonize(args.pidfile)
@@ -0,0 +1,803 @@
+#!/usr/bin/env python
+"""
+sage_server_bench.py -- micro-benchmarks for sage_server.py.
+
+Run from the directory containing sage_server.py using the same Python
+that runs the Sage server, e.g.,
+
+    sage --python sage_server_bench.py transport encoding cow namespace parsing blocks
+
+With no arguments, all benchmarks are run.
+"""
+
+#########################################################################################
+#       Copyright (C) 2013 William Stein <wstein@gmail.com>                             #
+#                                                                                       #
+#  Distributed under the terms of the GNU General Public License (GPL), version 2+      #
+#                                                                                       #
+#                  http://www.gnu.org/licenses/                                         #
+#########################################################################################
+
+import collections, gc, json, os, random, socket, string, struct, sys, threading, time, zlib
+
+PWD = os.path.split(os.path.realpath(__file__))[0]
+sys.path.insert(0, PWD)
+
+import sage_parsing, sage_server
+
+def _timeit(f, repeat=3):
+    """
+    Return the best wall time (in seconds) of calling f() repeat times.
+    """
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        f()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+#########################################################
+# Transport: framed send/recv over a local socket pair
+#########################################################
+
+class LegacyConnection(object):
+    """
+    The framing used by ConnectionJSON before the recv_into/MSG_MORE
+    transport: s += t while receiving and header + payload on send.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def _send(self, s):
+        self._conn.sendall(struct.pack(">L", len(s)) + s)
+
+    def send_frame(self, typ, sha, blob):
+        self._send(typ + sha + blob)
+
+    def _recv(self, n):
+        for i in range(20):
+            try:
+                return self._conn.recv(n)
+            except socket.error as (errno, msg):
+                if errno != 4:
+                    raise
+        raise EOFError
+
+    def recv(self):
+        n = self._recv(4)
+        if len(n) < 4:
+            raise EOFError
+        n = struct.unpack('>L', n)[0]
+        s = self._recv(n)
+        while len(s) < n:
+            t = self._recv(n - len(s))
+            if len(t) == 0:
+                raise EOFError
+            s += t
+        return 'blob', s[1:]
+
+class CurrentConnection(sage_server.ConnectionJSON):
+    def send_frame(self, typ, sha, blob):
+        self._send(typ, sha, blob)
+
+def _transfer(cls, size, count):
+    # Only the framing is measured; the sha1 is the same for both and omitted.
+    a, b = socket.socketpair()
+    sender, receiver = cls(a), cls(b)
+    blob = 'x'*size
+    sha = 'x'*36
+    def send():
+        for i in range(count):
+            sender.send_frame('b', sha, blob)
+    def run():
+        t = threading.Thread(target=send)
+        t.start()
+        for i in range(count):
+            receiver.recv()
+        t.join()
+    try:
+        return _timeit(run)
+    finally:
+        a.close(); b.close()
+
+def bench_transport(sizes=(2**10, 2**16, 2**20, 10*2**20, 50*2**20)):
+    """
+    Compare throughput of the legacy framing with ConnectionJSON for
+    messages from 1KB to 50MB.
+    """
+    print "%-10s %8s %14s %14s %8s"%("size", "count", "legacy MB/s", "current MB/s", "speedup")
+    for size in sizes:
+        count = max(1, 2**26 // size)   # about 64MB per run
+        mb = size * count / 2.0**20
+        old = _transfer(LegacyConnection, size, count)
+        new = _transfer(CurrentConnection, size, count)
+        print "%-10s %8s %14.1f %14.1f %8.2f"%(size, count, mb/old, mb/new, old/new)
+
+#########################################################
+# Encoding: size and cost of typical messages on the wire
+#########################################################
+
+def _stdout_burst(lines=2000):
+    # What a loop printing numbers produces once OutputBuffer batches it.
+    random.seed(0)
+    out = ''.join("%s %s\n"%(i, random.random()) for i in range(lines))
+    return {'event':'output', 'id':'6c5b0a88-3a5e-4bb3-9b42-5f2b8c1b4b8e', 'stdout':out}
+
+def _graphics3d(n=4000):
+    # Salvus.threed sends the scene from graphics.graphics3d_to_jsonable as a
+    # blob; this is the shape of one for a parametric surface: an
+    # index_face_set with float vertex coordinates and quad faces.
+    random.seed(0)
+    vertices = [round(random.uniform(-5, 5), 12) for i in range(3*n)]
+    faces = [[i, i+1, i+2, i+3] for i in range(0, n-3, 1)]
+    obj = {'type':'index_face_set', 'face_geometry':faces, 'vertex_geometry':vertices,
+           'has_local_colors':False,
+           'material':{'opacity':1, 'ambient':[0.0, 0.0, 0.8], 'diffuse':[0.0, 0.0, 1.0],
+                       'specular':[0.0, 0.0, 0.0], 'color':[0.4, 0.4, 1.0],
+                       'name':'texture32', 'shininess':1}}
+    scene = {'opts':{'width':None, 'height':None, 'frame':{'draw':True}}, 'obj':[obj]}
+    return json.dumps(scene, separators=(',', ':'))
+
+def _interact_layout(controls=20):
+    # An interact with a grid of sliders, like InteractCell.jsonable() sends.
+    ctrls = [{'control_type':'slider', 'var':'x%s'%i, 'label':'x%s'%i, 'default':50,
+              'vals':[str(j) for j in range(100)], 'animate':True, 'width':None,
+              'display_value':True} for i in range(controls)]
+    layout = [[['x%s'%i, 12, None]] for i in range(controls)]
+    return {'event':'output', 'id':'6c5b0a88-3a5e-4bb3-9b42-5f2b8c1b4b8e',
+            'interact':{'id':'5f0cb4f6-2a6b-4f5b-9d0e-9f1a5a7c8d2e', 'controls':ctrls,
+                        'layout':layout, 'width':None, 'style':None, 'flicker':False}}
+
+class _DefaultEncoding(sage_server.ConnectionJSON):
+    """
+    The encoding used before compact separators and negotiated compression.
+    """
+    def __init__(self, wire=None):
+        self._compress_threshold = None
+        self._msgpack = False
+        self.set_wire(wire)
+
+    def encode(self, m):
+        return 'j', json.dumps(m)
+
+class _Encoding(_DefaultEncoding):
+    encode = sage_server.ConnectionJSON.encode
+
+def bench_encoding(count=20):
+    """
+    Compare the size and encode/decode time of stdout bursts, 3d
+    graphics scenes (sent as blobs) and interact layouts for each wire
+    encoding that can be negotiated (msgpack only if it is installed).
+    """
+    encodings = [('json', _DefaultEncoding()),
+                 ('compact', _Encoding()),
+                 ('compact+zlib', _Encoding({'compress':'zlib'}))]
+    if sage_server.msgpack is not None:
+        encodings += [('msgpack', _Encoding({'encoding':'msgpack'})),
+                      ('msgpack+zlib', _Encoding({'encoding':'msgpack', 'compress':'zlib'}))]
+    sha = 'x'*36
+    messages = [('stdout', 'json', _stdout_burst()), ('graphics3d', 'blob', _graphics3d()),
+                ('interact', 'json', _interact_layout())]
+    print "%-12s %-14s %10s %8s %12s %12s"%("message", "encoding", "bytes", "ratio", "encode ms", "decode ms")
+    for name, kind, m in messages:
+        base = None
+        for enc, conn in encodings:
+            if kind == 'blob':
+                f = lambda: conn._compress('b', sha + m)
+            else:
+                f = lambda: conn.encode(m)
+            typ, payload = f()
+            frame = typ + payload
+            size = len(frame) + 4
+            if base is None:
+                base = size
+            t_enc = _timeit(lambda: [f() for i in range(count)]) / count
+            t_dec = _timeit(lambda: [conn._decode(frame) for i in range(count)]) / count
+            print "%-12s %-14s %10s %8.2f %12.3f %12.3f"%(name, enc, size, float(size)/base,
+                                                         1000*t_enc, 1000*t_dec)
+
+#########################################################
+# Copy on write: memory of a session forked from the server
+#########################################################
+
+def _session_growth(freeze, steps, step_time, keep):
+    # Fork a "session" that, as a user computation would, creates short
+    # lived objects and keeps some (keep per step), and sample its
+    # footprint as it goes.
+    thresholds = gc.get_threshold()
+    if freeze:
+        sage_server.freeze_gc()
+    else:
+        gc.collect()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        data = []
+        try:
+            for i in range(steps):
+                t = time.time()
+                # (lists, since dicts of atomic values aren't tracked by the gc)
+                data.append([[j] for j in range(keep)])
+                while time.time() - t < step_time:
+                    [[j] for j in range(1000)]
+                os.write(w, 'x')
+        finally:
+            os._exit(0)
+    os.close(w)
+    gc.set_threshold(*thresholds)
+    samples = []
+    for i in range(steps):
+        os.read(r, 1)
+        samples.append(sage_server.memory_footprint(pid))
+    os.waitpid(pid, 0)
+    os.close(r)
+    return samples
+
+def bench_cow(objects=300000, steps=10, step_time=0.5, keep=100000):
+    """
+    Compare how the private (copied) memory of a forked session grows
+    over time with the default garbage collector settings and with
+    gc_freeze, starting from a server heap of objects containers.
+    """
+    heap = [{'i':i, 'v':[i, str(i)]} for i in range(objects)]   # stands in for the Sage library
+    parent = sage_server.memory_footprint(os.getpid())
+    if parent is None:
+        print "no /proc/<pid>/smaps on this system"
+        return
+    print "server: Rss %s kB"%parent['Rss']
+    default = _session_growth(False, steps, step_time, keep)
+    frozen = _session_growth(True, steps, step_time, keep)
+    print "%-8s %18s %18s %18s %18s"%("seconds", "default private kB", "default shared kB",
+                                      "frozen private kB", "frozen shared kB")
+    for i, (a, b) in enumerate(zip(default, frozen)):
+        print "%-8.1f %18s %18s %18s %18s"%((i+1)*step_time, a['Private'], a['Shared'], b['Private'], b['Shared'])
+    del heap
+
+#########################################################
+# Namespace: assignments in a tight loop at the top level of a cell
+#########################################################
+
+class LegacyNamespace(dict):
+    """
+    Namespace before it could be observed with no overhead: every
+    assignment ran hooks immediately, whether anything observed or not.
+    """
+    def __init__(self, x):
+        self._on_change = {}
+        self._on_del = {}
+        dict.__init__(self, x)
+
+    def on(self, event, x, f):
+        handlers = self._on_change if event == 'change' else self._on_del
+        handlers.setdefault(x, []).append(f)
+
+    def __setitem__(self, x, y):
+        dict.__setitem__(self, x, y)
+        try:
+            if self._on_change.has_key(x):
+                for f in self._on_change[x]:
+                    f(y)
+            if self._on_change.has_key(None):
+                for f in self._on_change[None]:
+                    f(x, y)
+        except Exception, mesg:
+            print mesg
+
+    def __delitem__(self, x):
+        try:
+            if self._on_del.has_key(x):
+                for f in self._on_del[x]:
+                    f()
+            if self._on_del.has_key(None):
+                for f in self._on_del[None]:
+                    f(x)
+        except Exception, mesg:
+            print mesg
+        dict.__delitem__(self, x)
+
+def _observed(ns):
+    changed = []
+    ns.on('change', None, lambda x, y: changed.append(x))
+    return ns
+
+def bench_namespace(n=10**6):
+    """
+    Time a cell whose top level assigns variables in a tight loop (the
+    assignments go through the namespace, unlike in a function), with
+    each kind of namespace, with and without an observer.
+    """
+    code = compile("for i in xrange(%s):\n    x = i\n    y = x\n    del y\n"%n, '', 'exec')
+    def run(make):
+        def f():
+            ns = make()
+            exec code in ns
+            if isinstance(ns, sage_server.Namespace):
+                ns.notify()
+        return _timeit(f)
+    namespaces = [('dict', dict),
+                  ('legacy', lambda: LegacyNamespace({})),
+                  ('namespace', lambda: sage_server.Namespace({})),
+                  ('legacy observed', lambda: _observed(LegacyNamespace({}))),
+                  ('namespace observed', lambda: _observed(sage_server.Namespace({})))]
+    base = None
+    print "%-20s %10s %14s %8s"%("namespace", "seconds", "ns/assignment", "vs dict")
+    for name, make in namespaces:
+        t = run(make)
+        if base is None:
+            base = t
+        print "%-20s %10.3f %14.1f %8.2f"%(name, t, 1e9*t/(3*n), t/base)
+
+#########################################################
+# Parsing: strip_string_literals and divide_into_blocks on large cells
+#########################################################
+
+def legacy_strip_string_literals(code, state=None):
+    """
+    sage_parsing.strip_string_literals before the single pass scanner:
+    three find calls per step, each of which may scan to the end.
+    """
+    new_code = []
+    literals = {}
+    counter = 0
+    start = q = 0
+    if state is None:
+        in_quote = False
+        raw = False
+    else:
+        in_quote, raw = state
+    while True:
+        sig_q = code.find("'", q)
+        dbl_q = code.find('"', q)
+        hash_q = code.find('#', q)
+        q = min(sig_q, dbl_q)
+        if q == -1: q = max(sig_q, dbl_q)
+        if not in_quote and hash_q != -1 and (q == -1 or hash_q < q):
+            # it's a comment
+            newline = code.find('\n', hash_q)
+            if newline == -1: newline = len(code)
+            counter += 1
+            label = "L%s" % counter
+            literals[label] = code[hash_q:newline]   # changed from sage
+            new_code.append(code[start:hash_q].replace('%','%%'))
+            new_code.append("%%(%s)s" % label)
+            start = q = newline
+        elif q == -1:
+            if in_quote:
+                counter += 1
+                label = "L%s" % counter
+                literals[label] = code[start:]
+                new_code.append("%%(%s)s" % label)
+            else:
+                new_code.append(code[start:].replace('%','%%'))
+            break
+        elif in_quote:
+            if code[q-1] == '\\':
+                k = 2
+                while code[q-k] == '\\':
+                    k += 1
+                if k % 2 == 0:
+                    q += 1
+            if code[q:q+len(in_quote)] == in_quote:
+                counter += 1
+                label = "L%s" % counter
+                literals[label] = code[start:q+len(in_quote)]
+                new_code.append("%%(%s)s" % label)
+                q += len(in_quote)
+                start = q
+                in_quote = False
+            else:
+                q += 1
+        else:
+            raw = q>0 and code[q-1] in 'rR'
+            if len(code) >= q+3 and (code[q+1] == code[q] == code[q+2]):
+                in_quote = code[q]*3
+            else:
+                in_quote = code[q]
+            new_code.append(code[start:q].replace('%', '%%'))
+            start = q
+            q += len(in_quote)
+
+    return "".join(new_code), literals, (in_quote, raw)
+
+def check_strip_string_literals(cases=20000, seed=0):
+    """
+    Check that strip_string_literals returns exactly what the legacy
+    implementation does on random snippets made of the pieces that
+    matter (quotes, triple quotes, escapes, comments, newlines, raw
+    prefixes and %), starting in each state.  Returns the number of
+    cases checked.
+    """
+    random.seed(seed)
+    pieces = ['"', "'", '"'*3, "'"*3, '#', '\\', '\\\\', '\n', 'r', 'R', 'a', ' ', '%', 'x = ']
+    states = [None, (False, False), ('"', False), ("'", True), ('"'*3, False), ("'"*3, False)]
+    n = 0
+    for i in range(cases):
+        code = ''.join(random.choice(pieces) for j in range(random.randint(0, 30)))
+        for state in states:
+            new = sage_parsing.strip_string_literals(code, state)
+            old = legacy_strip_string_literals(code, state)
+            if new != old:
+                raise AssertionError("strip_string_literals(%r, %r) = %r, but was %r"%(code, state, new, old))
+            n += 1
+    return n
+
+def _cells(lines):
+    # Cells that are hard for a scanner that looks ahead for each of ', " and #.
+    yield 'mixed', ''.join("a%s = 'x' + \"y%%s\" %% i  # note\n"%i for i in range(lines))
+    yield 'strings', ''.join('s%s = "%s"\n'%(i, 'x'*20) for i in range(lines)) + "t = 'end'  # done\n"
+    yield 'long string', "s = '''\n" + ''.join('say "%s" and "%s"\n'%(i, i) for i in range(lines)) + "'''\n"
+
+def bench_parsing(sizes=(1000, 4000, 16000)):
+    """
+    Compare strip_string_literals with the legacy implementation on large
+    generated cells, after checking that they agree (see
+    check_strip_string_literals).
+    """
+    print "differential check: %s cases identical"%check_strip_string_literals()
+    print "%-12s %8s %10s %12s %12s %8s"%("cell", "lines", "chars", "legacy ms", "current ms", "speedup")
+    for lines in sizes:
+        for name, code in _cells(lines):
+            assert sage_parsing.strip_string_literals(code) == legacy_strip_string_literals(code)
+            old = _timeit(lambda: legacy_strip_string_literals(code))
+            new = _timeit(lambda: sage_parsing.strip_string_literals(code))
+            print "%-12s %8s %10s %12.2f %12.2f %8.1f"%(name, lines, len(code), 1000*old, 1000*new, old/new)
+
+def legacy_divide_into_blocks(code):
+    """
+    sage_parsing.divide_into_blocks before blocks were computed from
+    per-line bracket counts (and cached), less the code decorators.
+    """
+    code, literals, state = sage_parsing.strip_string_literals(code)
+    code = [x for x in code.splitlines() if x.strip()]
+    i = len(code)-1
+    blocks = []
+    while i >= 0:
+        stop = i
+        paren_depth = code[i].count('(') - code[i].count(')')
+        brack_depth = code[i].count('[') - code[i].count(']')
+        curly_depth = code[i].count('{') - code[i].count('}')
+        while i>=0 and ((len(code[i]) > 0 and (code[i][0] in string.whitespace or code[i][:2] == '%(')) or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
+            i -= 1
+            if i >= 0:
+                paren_depth += code[i].count('(') - code[i].count(')')
+                brack_depth += code[i].count('[') - code[i].count(']')
+                curly_depth += code[i].count('{') - code[i].count('}')
+        # remove comments
+        for k, v in literals.iteritems():
+            if v.startswith('#'):
+                literals[k] = ''
+        block = ('\n'.join(code[i:]))%literals
+        bs = block.strip()
+        if bs: # has to not be only whitespace
+            blocks.insert(0, [i, stop, bs])
+        code = code[:i]
+        i = len(code)-1
+
+    # merge try/except/finally/decorator/else/elif blocks
+    i = 1
+    def merge():
+        "Merge block i-1 with block i."
+        blocks[i-1][-1] += '\n' + blocks[i][-1]
+        blocks[i-1][1] = blocks[i][1]
+        del blocks[i]
+
+    while i < len(blocks):
+        s = blocks[i][-1].lstrip()
+        if (s.startswith('finally') or s.startswith('except')) and blocks[i-1][-1].lstrip().startswith('try'):
+            merge()
+        elif s.startswith('def') and blocks[i-1][-1].splitlines()[-1].lstrip().startswith('@'):
+            merge()
+        elif s.startswith('else') and (blocks[i-1][-1].lstrip().startswith('if') or blocks[i-1][-1].lstrip().startswith('while') or blocks[i-1][-1].lstrip().startswith('for') or blocks[i-1][-1].lstrip().startswith('elif')):
+            merge()
+        elif s.startswith('elif') and blocks[i-1][-1].lstrip().startswith('if'):
+            merge()
+        else:
+            i += 1
+
+    return blocks
+
+def check_divide_into_blocks(cases=5000, seed=0):
+    """
+    Check that divide_into_blocks returns exactly what the legacy
+    implementation does on random cells made of lines that matter
+    (indentation, brackets opened and closed on other lines, strings
+    spanning lines, comments, try/except, decorators, if/else); every
+    tenth cell is longer, so that the search for the start of a block
+    goes past the first few lines that could start one.  Returns the
+    number of cases checked.
+    """
+    random.seed(seed)
+    lines = ['x = 1', '    y = 2', '\tz', 'f(', '  1)', ')', '[1,', '2]', '{', '}', '"""a', 'b"""', "'s'",
+             '# c', 'x = 1  # c', 'if x:', 'elif y:', 'else:', 'for i in v:', 'while 0:', 'try:',
+             'except:', 'finally:', '@dec', 'def f():', '', '   ', 'a = (1,', '     2)', '])', '  ]', '})',
+             '(]', '  )]', '  )[']
+    for i in range(cases):
+        code = '\n'.join(random.choice(lines) for j in range(random.randint(0, 25 if i % 10 else 200)))
+        new = sage_parsing._divide_into_blocks(code)
+        old = legacy_divide_into_blocks(code)
+        if new != old:
+            raise AssertionError("divide_into_blocks(%r) = %r, but was %r"%(code, new, old))
+    return cases
+
+def _program(lines):
+    # A pasted program: top level statements, functions, loops and data.
+    random.seed(0)
+    v = []
+    while len(v) < lines:
+        k = len(v)
+        v.extend(random.choice([
+            ['x%s = %s'%(k, k)],
+            ['def f%s(n):'%k, '    """', '    Docstring.', '    """', '    return [n*i for i in range(n)]  # list', ''],
+            ['for i in range(%s):'%k, '    if i %% 2:', '        print i', '    else:', '        pass'],
+            ['d%s = {'%k, "    'a': (1, 2),", "    'b': [3, 4],", '}'],
+            ['try:', '    f(1)', 'except Exception:', '    pass']]))
+    return '\n'.join(v)
+
+def _pasted(lines):
+    # Pasted cells: a program; the same program indented, as when copied
+    # out of a function body, so no line starts a block; and the end of
+    # a data structure whose opening brackets weren't pasted; and lines
+    # that each close one kind of bracket and open another, followed by
+    # lines that none of them can start a block with.
+    yield 'program', _program(lines)
+    yield 'indented', '\n'.join('    ' + x for x in _program(lines).splitlines())
+    yield 'unbalanced', '\n'.join(random.choice(['    1, 2],', '    3)', ')', '},', 'x = 1']) for i in range(lines))
+    yield 'interleaved', '\n'.join([')', '(]']*(lines//4) + ['  )]'] + ['    )[', '    x']*(lines//4))
+
+def bench_blocks(sizes=(500, 2000, 4000)):
+    """
+    Compare divide_into_blocks with the legacy implementation on pasted
+    cells (both parsing), and with executing the same cell again
+    (cached), after checking that they agree (see check_divide_into_blocks).
+    """
+    print "differential check: %s cases identical"%check_divide_into_blocks()
+    print "%-12s %8s %10s %12s %12s %12s %8s"%("cell", "lines", "chars", "legacy ms", "current ms", "cached ms", "speedup")
+    for lines in sizes:
+        for name, code in _pasted(lines):
+            assert sage_parsing._divide_into_blocks(code) == legacy_divide_into_blocks(code)
+            old = _timeit(lambda: legacy_divide_into_blocks(code), repeat=1)   # quadratic; seconds
+            new = _timeit(lambda: sage_parsing._divide_into_blocks(code))
+            sage_parsing.divide_into_blocks(code)
+            cached = _timeit(lambda: sage_parsing.divide_into_blocks(code))
+            print "%-12s %8s %10s %12.2f %12.2f %12.2f %8.1f"%(name, lines, len(code), 1000*old, 1000*new, 1000*cached, old/new)
+
+#########################################################
+# Completion: names in a large namespace and attributes of objects
+#########################################################
+
+def legacy_completions(namespace, expr):
+    # sage_parsing.introspect on a simple identifier, before the prefix index.
+    j = len(expr)
+    v = [x[j:] for x in (namespace.keys() + sage_parsing._builtin_completions) if x.startswith(expr)]
+    return list(sorted(set(v), lambda x,y:cmp(x.lower(),y.lower())))
+
+def legacy_attribute_completions(O, target):
+    # sage_parsing.introspect on obj.<tab>, before attributes were cached.
+    v = dir(O)
+    if hasattr(O, 'trait_names'):
+        v += O.trait_names()
+    if not target.startswith('_'):
+        v = [x for x in v if x and not x.startswith('_')]
+    j = len(target)
+    v = [x[j:] for x in v if x.startswith(target)]
+    return list(sorted(set(v), lambda x,y:cmp(x.lower(),y.lower())))
+
+def _same_completions(new, old):
+    # The legacy order of names equal up to case depends on a set.
+    return new == sorted(old, key=sage_parsing._completion_key)
+
+class _Traits(object):
+    def __init__(self):
+        self.alpha = 1
+    def trait_names(self):
+        return ['alpha', 'beta', 'Beta', '_gamma']
+
+class _Dir(object):
+    def __dir__(self):
+        return ['x', 'y', 'Xy']
+
+class _Classic:
+    def method(self):
+        pass
+
+def check_completions(cases=3000, seed=0):
+    """
+    Check that completing names (as the namespace changes) and
+    attributes (of instances, classes as they change, modules, builtin
+    objects, ...)
+    gives what the legacy implementation does.  Returns the number of
+    cases checked.
+    """
+    random.seed(seed)
+    pool = ['a', 'A', 'ab', 'aB', 'abc', 'b', 'print_', 'pr', '_x', '__y', 'len', 'lenx', 'f%s', 'F%s', u'u%s']
+    prefixes = ['', 'a', 'A', 'ab', 'p', 'pr', 'f1', 'F', '_', '__', 'l', 'le', 'u', 'z', 'i']
+    namespace = sage_server.Namespace({})
+    sage_parsing.namespace_changed()
+    c = _Traits(); c.Alpha = 2; c.zeta = 3
+    objects = [c, _Traits(), _Dir(), _Classic(), _Classic, string, 10, 'abc', [1], {}, 2.5, None,
+               sage_server.Namespace, namespace]
+    for i in range(cases):
+        # Run code that assigns and deletes names and class attributes (or
+        # nothing, as between tab presses), and complete.
+        changes = random.choice([0, 0, 1, 1, 3, 100])
+        for k in range(changes):
+            x = random.choice(pool)
+            if '%' in x:
+                x = x%random.randint(0, 50)
+            if x in namespace and random.random() < 0.5:
+                del namespace[x]
+            else:
+                namespace[x] = i
+        if random.random() < 0.1:
+            changes += 1
+            x = 'method%s'%random.randint(0, 3)
+            if hasattr(_Traits, x):
+                delattr(_Traits, x)
+            else:
+                setattr(_Traits, x, len)
+        if changes or random.random() < 0.5:
+            sage_parsing.namespace_changed()
+        prefix = random.choice(prefixes)
+        new = sage_parsing.introspect(prefix, namespace, preparse=False)['result']
+        old = legacy_completions(namespace, prefix)
+        if not _same_completions(new, old):
+            raise AssertionError("completions of %r are %r, but were %r"%(prefix, new, old))
+        O = random.choice(objects)
+        new = [x[len(prefix):] for x in sage_parsing.attribute_completions(O, prefix)]
+        old = legacy_attribute_completions(O, prefix)
+        if not _same_completions(new, old):
+            raise AssertionError("attributes of %r starting with %r are %r, but were %r"%(O, prefix, new, old))
+    return cases
+
+def bench_completion(names=30000, attributes=2000, prefixes=('', 'f', 'fa', 'fac', 'x1')):
+    """
+    Compare completing names in a namespace with as many names as Sage's,
+    and attributes of an object with as many as a Sage element, with the
+    legacy implementation, after checking that they agree (see
+    check_completions): on tab again (nothing ran since the last
+    completion) and after code assigned a name.
+    """
+    print "differential check: %s cases identical"%check_completions()
+    random.seed(0)
+    def name(i):
+        return '%s%s'%(''.join(random.choice(string.ascii_letters) for j in range(random.randint(1, 12))), i)
+    namespace = sage_server.Namespace((name(i), i) for i in range(names))
+    namespace['factor'] = namespace['factorial'] = 1
+    O = type('Element', (object,), dict((name(i), i) for i in range(attributes)))()
+    counter = [0]
+    def run_code():
+        counter[0] += 1
+        namespace['new%s'%counter[0]] = 1
+        sage_parsing.namespace_changed()
+    print "%s names, %s attributes"%(len(namespace), len(dir(O)))
+    print "%10s %10s %12s %12s %14s"%("prefix", "matches", "legacy ms", "tab ms", "after code ms")
+    for prefix in prefixes:
+        for complete, legacy, obj in [(sage_parsing.namespace_completions, legacy_completions, namespace),
+                                      (sage_parsing.attribute_completions, legacy_attribute_completions, O)]:
+            matches = len(legacy(obj, prefix))
+            old = _timeit(lambda: legacy(obj, prefix))
+            complete(obj, prefix)
+            again = _timeit(lambda: complete(obj, prefix))
+            def after_code():
+                run_code(); complete(obj, prefix)
+            after = _timeit(after_code)
+            label = repr(prefix) if obj is namespace else 'O.' + prefix
+            print "%10s %10s %12.2f %12.2f %14.2f"%(label, matches, 1000*old, 1000*again, 1000*after)
+
+#########################################################
+# Resolve: looking up the object of an introspection without evaluating code
+#########################################################
+
+_computed = []   # attributes computed by code, which resolve must not run
+
+class _Meta(type):
+    def meta_method(cls):
+        pass
+
+class _Base(object):
+    __metaclass__ = _Meta
+    base_attr = 5
+    def method(self):
+        pass
+    @staticmethod
+    def static():
+        pass
+    @classmethod
+    def klass(cls):
+        pass
+
+class _Resolved(_Base):
+    __slots__ = ('slot', 'unset')
+    def __init__(self):
+        self.slot = 'abc'
+    @property
+    def prop(self):
+        _computed.append('prop')
+        return 'abc'
+
+class _GetAttr(object):
+    attr = 1
+    def __getattr__(self, name):
+        _computed.append('__getattr__')
+        return 1
+
+class _GetAttribute(object):
+    def __getattribute__(self, name):
+        _computed.append('__getattribute__')
+        return 1
+
+class _Items(list):
+    def __getitem__(self, i):
+        _computed.append('__getitem__')
+        return 1
+
+class _OldStyle:
+    attr = 1
+    def method(self):
+        pass
+
+def check_resolve():
+    """
+    Check that resolve finds what eval does for expressions made of names,
+    attributes and constant subscripts, and refuses those that only code
+    (properties, __getattr__, __getattribute__, __getitem__, __missing__)
+    would compute, without running it.  Returns the number of expressions
+    checked.
+    """
+    d = collections.defaultdict(list); d['a'] = [1]
+    namespace = {'r':_Resolved(), 'R':_Resolved, 'g':_GetAttr(), 'h':_GetAttribute(), 'items':_Items([1]),
+                 'o':_OldStyle(), 'O':_OldStyle, 'd':d, 'v':[[1, 'ab'], {'k':(2, 3)}], 'string':string, 'f':len}
+    resolved = ['r', 'r.method', 'r.static', 'r.klass', 'r.slot', 'r.slot.upper', 'r.base_attr', 'R', 'R.method',
+                'R.prop', 'R.slot', 'R.meta_method', 'R.__mro__', 'R.__name__', 'g', 'g.attr', 'h', 'o', 'o.attr',
+                'o.method', 'O.method', 'items', "d['a']", 'v[0][1]', 'v[-1]', "v[1]['k'][0]", 'string.digits',
+                'f', 'f.__name__', 'None.__class__', 'int.real', '"abc"', '(1, 2)', 'len']
+    refused = ['r.prop', 'r.prop.upper', 'r.unset', 'r.nothing', 'g.x', 'h.x', 'o.nothing', 'items[0]', "d['b']",
+               'v[5]', 'v[0:1]', 'v[f]', 'f(1)', 'undefined', 'string.nothing', 'r.__dict__']
+    for expr in resolved:
+        x = sage_parsing.resolve(expr, namespace)
+        y = eval(expr, dict(namespace))
+        if not (x is y or x == y):
+            raise AssertionError("resolve(%r) = %r, but eval gives %r"%(expr, x, y))
+    del _computed[:]
+    for expr in refused:
+        try:
+            x = sage_parsing.resolve(expr, namespace)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("resolve(%r) = %r, but should be refused"%(expr, x))
+    if _computed or d.keys() != ['a']:
+        raise AssertionError("resolve ran code: %s"%_computed)
+    return len(resolved) + len(refused)
+
+def bench_resolve(count=10000):
+    """
+    Compare looking up the object of a completion such as r.slot.<tab>
+    with resolve and evaluating it (as introspection did), after checking
+    resolve (see check_resolve).
+    """
+    print "check: %s expressions resolved or refused as expected"%check_resolve()
+    namespace = {'r':_Resolved(), 'v':[{'k':_Resolved()}]}
+    print "%20s %12s %12s"%("expression", "eval us", "resolve us")
+    for expr in ['r', 'r.slot', "v[0]['k'].method"]:
+        old = _timeit(lambda: [eval(expr, namespace) for i in xrange(count)])
+        new = _timeit(lambda: [sage_parsing.resolve(expr, namespace) for i in xrange(count)])
+        print "%20s %12.2f %12.2f"%(expr, 1e6*old/count, 1e6*new/count)
+
+BENCHMARKS = {'transport' : bench_transport,
+              'encoding'  : bench_encoding,
+              'cow'       : bench_cow,
+              'namespace' : bench_namespace,
+              'parsing'   : bench_parsing,
+              'blocks'    : bench_blocks,
+              'completion': bench_completion,
+              'resolve'   : bench_resolve}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        print "== %s =="%name
+        BENCHMARKS[name]()